@@ -1,26 +1,73 @@
+import json
 import os
 import sys
 import numpy as np
-from cutout.sdss import sdss_fields, single_field_image, read_match_csv
+from cutout.sdss import (
+    sdss_fields, prefetch_fields, read_match_csv
+)
 from cutout.utils import align_images
 from cutout.sex import run_sex
+from cutout.store import consolidate
 from cutout.create import (
     get_cutout,
     sequential_sex, parallel_sex,
-    sequential_match, parallel_match
+    sequential_match, parallel_match, local_parallel_match,
+    incremental_match, pipeline_match, pipeline_sex
 )
 
 
+def pop_option(args, name, default=None):
+    """
+    Removes an option such as '--align numpy' from the argument list
+    and returns its value.
+    """
+
+    if name not in args:
+        return default
+
+    i = args.index(name)
+    value = args[i + 1]
+    del args[i: i + 2]
+
+    return value
+
+
 def main(args=None):
 
     if args is None:
         args = sys.argv[1:]
 
+    args = list(args)
+
+    # the benchmark runs without Montage and SExtractor by default.
+    if args[:1] == ["benchmark"]:
+        method = pop_option(args, "--align", "numpy")
+        detector = pop_option(args, "--detect", "numpy")
+    else:
+        method = pop_option(args, "--align", "montage")
+        detector = pop_option(args, "--detect", "sex")
+
+    workers = pop_option(args, "--workers")
+    max_fields = int(pop_option(args, "--max-fields", 8))
+    shard_size = int(pop_option(args, "--shard-size", 65536))
+    image_dtype = pop_option(args, "--dtype", "float32")
+    n_fields = int(pop_option(args, "--fields", 4))
+    baseline = pop_option(args, "--baseline")
+    output = pop_option(args, "--output", "benchmark.json")
+    dataset = pop_option(args, "--dataset")
+
+    # e.g. '--size 32,64,128' cuts out all three sizes in one pass.
+    size = [int(s) for s in pop_option(args, "--size", "64").split(",")]
+    if len(size) == 1:
+        size = size[0]
+
     # check for subcommand
     if len(args) == 0:
         sys.stderr.write(
             "Usage: cutout <subcommand>\n"
-            "Valid subcommands are: sequential, parallel, fetch, align, extract\n"
+            "Valid subcommands are: sequential, parallel, local-parallel, "
+            "incremental, pipeline, consolidate, benchmark, metrics, fetch, align, "
+            "extract\n"
         )
         return 1
 
@@ -29,7 +76,52 @@ def main(args=None):
             sys.stderr.write(
                 "Usage: cutout sequential match <CSV file>\n"
             )
-        parallel_match(args[2])
+        parallel_match(
+            args[2], method=method, image_dtype=image_dtype, size=size
+        )
+
+    elif args[0] == "local-parallel":
+        if len(args[1:]) < 2 or args[1] != "match":
+            sys.stderr.write(
+                "Usage: cutout local-parallel match <CSV file> [--workers N]\n"
+            )
+            return 1
+        local_parallel_match(
+            args[2],
+            workers=int(workers) if workers is not None else None,
+            method=method, image_dtype=image_dtype, size=size
+        )
+
+    elif args[0] == "incremental":
+        if len(args[1:]) < 2 or args[1] != "match":
+            sys.stderr.write(
+                "Usage: cutout incremental match <CSV file> "
+                "[--dataset <dataset dir>]\n"
+            )
+            return 1
+        incremental_match(
+            args[2], method=method, image_dtype=image_dtype, size=size,
+            dataset=dataset
+        )
+
+    elif args[0] == "pipeline" and args[1:2] == ["match"]:
+        if len(args[2:]) == 0:
+            sys.stderr.write(
+                "Usage: cutout pipeline match <CSV file> [--max-fields N]\n"
+            )
+            return 1
+        pipeline_match(
+            args[2], method=method, max_fields=max_fields,
+            image_dtype=image_dtype, size=size
+        )
+
+    elif args[0] == "pipeline":
+        if os.path.exists("fetch.csv"):
+            df = sdss_fields("fetch.csv")
+            pipeline_sex(
+                df, method=method, max_fields=max_fields, detector=detector,
+                size=size
+            )
 
     elif args[0] == "sequential" and len(args[1:]) == 0:
         sys.stderr.write(
@@ -40,7 +132,7 @@ def main(args=None):
     elif args[0] == "parallel":
         if os.path.exists("fetch.csv"):
             df = sdss_fields("fetch.csv")
-            parallel_sex(df)
+            parallel_sex(df, method=method, detector=detector, size=size)
 
 
     elif args[0] == "sequential" and args[1] == "match":
@@ -48,12 +140,50 @@ def main(args=None):
             sys.stderr.write(
                 "Usage: cutout sequential match <CSV file>\n"
             )
-        sequential_match(args[2])
+        sequential_match(
+            args[2], method=method, image_dtype=image_dtype, size=size
+        )
 
     elif args[0] == "sequential":
         if os.path.exists("fetch.csv"):
             df = sdss_fields("fetch.csv")
-            sequential_sex(df)
+            sequential_sex(df, method=method, detector=detector, size=size)
+
+    elif args[0] == "consolidate":
+        if len(args[1:]) < 2:
+            sys.stderr.write(
+                "Usage: cutout consolidate <result dir> <output dir> "
+                "[--shard-size N]\n"
+            )
+            return 1
+        dataset = consolidate(args[1], args[2], shard_size=shard_size)
+        print(
+            "Packed {} objects into {} shards.".format(
+                len(dataset), len(dataset.shards)
+            )
+        )
+
+    elif args[0] == "benchmark":
+        from cutout.benchmark import run_benchmark, write_results, print_results
+        results = run_benchmark(
+            work_dir=args[1] if len(args) > 1 else "benchmark",
+            n_fields=n_fields, method=method, detector=detector
+        )
+        if baseline is not None:
+            with open(baseline) as f:
+                baseline = json.load(f)
+        print_results(results, baseline)
+        write_results(results, output)
+
+    elif args[0] == "metrics":
+        from cutout.metrics import metrics_dir, report
+        directory = args[1] if len(args) > 1 else metrics_dir()
+        if directory is None:
+            sys.stderr.write(
+                "Usage: cutout metrics <metrics dir>\n"
+            )
+            return 1
+        report(directory)
 
     elif args[0] == "fetch":
         if os.path.exists("fetch.csv"):
@@ -64,10 +194,13 @@ def main(args=None):
         else:
             df = sdss_fields(args[1])
 
-        for idx, row in df.iterrows():
-            single_field_image(
-                row["rerun"], row["run"], row["camcol"], row["field"]
-            )
+        fields = df[["rerun", "run", "camcol", "field"]].values
+
+        for field, error in prefetch_fields(fields):
+            if error is not None:
+                print(error)
+            else:
+                print("{0}-{1}-{2}-{3}: Fetched.".format(*field))
    
     elif args[0] == "align":
         images = [
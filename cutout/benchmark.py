@@ -0,0 +1,382 @@
+import bz2
+import functools
+import json
+import os
+import resource
+import shutil
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy import wcs
+from cutout.create import align_field, get_cutout, run_detection
+from cutout.sdss import (
+    df_radec_to_pixel, fetch_fields, field_wcs, fits_file_name
+)
+
+
+STAGES = ["fetch", "radec", "align", "detect", "cutout"]
+
+# pixel offsets of each band from the r band, as between the SDSS
+# filters of a camera column.
+BAND_OFFSETS = {
+    "u": (3.4, -2.1),
+    "g": (1.7, -0.6),
+    "r": (0.0, 0.0),
+    "i": (-1.3, 0.8),
+    "z": (-2.6, 1.9)
+}
+
+
+def synthetic_fields(n_fields=4):
+    """
+    Returns a list of (rerun, run, camcol, field) for the benchmark.
+    """
+
+    return [(301, 1000, 1, 27 + i) for i in range(n_fields)]
+
+
+def synthetic_wcs(field, band, shape=(1489, 2048)):
+    """
+    Returns a TAN WCS similar to that of an SDSS frame: 0.396 arcsec
+    pixels, slightly rotated, centred on a position that depends on
+    the field, and shifted by a few pixels in each band.
+    """
+
+    rerun, run, camcol, field_ = field
+    ny, nx = shape
+
+    scale = 0.396 / 3600.0
+    angle = np.radians(0.5)
+    dx, dy = BAND_OFFSETS[band]
+
+    w = wcs.WCS(naxis=2)
+    w.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    w.wcs.crpix = [nx / 2.0 + 0.5 + dx, ny / 2.0 + 0.5 + dy]
+    w.wcs.crval = [150.0 + field_ * ny * scale, 2.0 + camcol * 0.25]
+    w.wcs.cd = scale * np.array([
+        [-np.cos(angle), np.sin(angle)],
+        [np.sin(angle), np.cos(angle)]
+    ])
+
+    return w
+
+
+def synthetic_sources(field, n_sources=500, shape=(1489, 2048), seed=0):
+    """
+    Returns a pandas dataframe of sources at random positions in the
+    r band frame of a field, with columns objID, ra, dec, rerun, run,
+    camcol and field, and a flux (nanomaggies) and width (pixels).
+    """
+
+    rerun, run, camcol, field_ = field
+    ny, nx = shape
+
+    rng = np.random.RandomState(seed + field_)
+
+    x = rng.uniform(8, nx - 8, n_sources)
+    y = rng.uniform(8, ny - 8, n_sources)
+
+    ra, dec = synthetic_wcs(field, "r", shape).all_pix2world(x, y, 0)
+
+    objID = (
+        np.uint64(run) * np.uint64(10 ** 9) + np.uint64(field_) * np.uint64(10 ** 5)
+        + np.arange(n_sources, dtype=np.uint64)
+    )
+
+    return pd.DataFrame({
+        "objID": objID,
+        "ra": ra,
+        "dec": dec,
+        "rerun": rerun,
+        "run": run,
+        "camcol": camcol,
+        "field": field_,
+        "flux": rng.lognormal(1.0, 1.0, n_sources),
+        "width": rng.uniform(1.0, 3.0, n_sources)
+    })
+
+
+def synthetic_frame(field, band, sources, shape=(1489, 2048), noise=0.02,
+    seed=0):
+    """
+    Returns a FITS HDU list of a single band frame with the sources
+    rendered as Gaussians on a noisy sky, in nanomaggies.
+    """
+
+    rerun, run, camcol, field_ = field
+    ny, nx = shape
+
+    rng = np.random.RandomState(seed + field_ * 8 + "ugriz".index(band))
+
+    data = rng.normal(0.0, noise, shape).astype(np.float32)
+
+    w = synthetic_wcs(field, band, shape)
+    x, y = w.all_world2pix(sources["ra"].values, sources["dec"].values, 0)
+
+    radius = 10
+    offsets = np.arange(-radius, radius + 1)
+
+    for xi, yi, flux, width in zip(
+        x, y, sources["flux"].values, sources["width"].values):
+
+        x0 = int(round(xi))
+        y0 = int(round(yi))
+        if x0 < radius or y0 < radius:
+            continue
+        if x0 >= nx - radius or y0 >= ny - radius:
+            continue
+
+        gx = np.exp(-0.5 * ((x0 + offsets - xi) / width) ** 2)
+        gy = np.exp(-0.5 * ((y0 + offsets - yi) / width) ** 2)
+        stamp = np.outer(gy, gx)
+        stamp *= flux / stamp.sum()
+
+        data[y0 - radius: y0 + radius + 1, x0 - radius: x0 + radius + 1] += (
+            stamp
+        )
+
+    header = w.to_header()
+    header["FILTER"] = band
+    header["BUNIT"] = "nanomaggy"
+
+    return fits.HDUList([fits.PrimaryHDU(data, header=header)])
+
+
+def generate_mirror(root, fields, bands="ugriz", n_sources=500,
+    shape=(1489, 2048), seed=0):
+    """
+    Writes bz2-compressed synthetic frames to
+    <root>/<rerun>/<run>/<camcol>/, laid out like the SDSS server, and
+    returns the catalog of injected sources. Frames that already exist
+    are not generated again.
+    """
+
+    catalogs = []
+
+    for field in fields:
+
+        rerun, run, camcol, field_ = field
+        sources = synthetic_sources(field, n_sources, shape, seed)
+        catalogs.append(sources)
+
+        field_dir = os.path.join(root, str(rerun), str(run), str(camcol))
+        if not os.path.exists(field_dir):
+            os.makedirs(field_dir)
+
+        for band in bands:
+
+            path = os.path.join(
+                field_dir, fits_file_name(*field, band=band) + ".bz2"
+            )
+            if os.path.exists(path):
+                continue
+
+            hdulist = synthetic_frame(field, band, sources, shape, seed=seed)
+            hdulist.writeto(path + ".fits", overwrite=True)
+
+            with open(path + ".fits", "rb") as f_in:
+                with bz2.open(path + ".tmp", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+
+            os.remove(path + ".fits")
+            os.replace(path + ".tmp", path)
+
+    return pd.concat(catalogs, ignore_index=True)
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_mirror(root):
+    """
+    Serves root over HTTP on localhost in a background thread.
+
+    Returns
+    -------
+    A tuple of (server, url). Call server.shutdown() to stop it.
+    """
+
+    handler = functools.partial(_QuietHandler, directory=root)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = "http://127.0.0.1:{}/".format(server.server_address[1])
+
+    return server, url
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in megabytes.
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_benchmark(work_dir="benchmark", n_fields=4, n_sources=500,
+    method="numpy", detector="numpy", shape=(1489, 2048)):
+    """
+    Runs each stage of the package on synthetic fields served from a
+    local HTTP mirror, and times the stages separately.
+
+    The stages are run one after another on all fields: fetch (with
+    fetch_fields), radec (df_radec_to_pixel), align (align_field),
+    detect (run_detection) and cutout (get_cutout of the injected
+    sources). By default, the NumPy alignment and detection are used,
+    so neither Montage nor SExtractor is needed.
+
+    Returns
+    -------
+    A dictionary of results (see write_results).
+    """
+
+    work_dir = os.path.abspath(work_dir)
+    mirror_dir = os.path.join(work_dir, "mirror")
+    run_dir = os.path.join(work_dir, "run")
+
+    fields = synthetic_fields(n_fields)
+    bands = [b for b in "ugriz"]
+
+    print("Generating {} synthetic fields...".format(n_fields))
+    catalog = generate_mirror(mirror_dir, fields, n_sources=n_sources,
+        shape=shape)
+
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+
+    server, url = serve_mirror(mirror_dir)
+
+    cwd = os.getcwd()
+    environ = os.environ.get("CUTOUT_SDSS_URL")
+
+    timings = dict((stage, 0.0) for stage in STAGES)
+
+    try:
+        os.chdir(run_dir)
+        os.environ["CUTOUT_SDSS_URL"] = url
+        field_wcs.cache_clear()
+
+        start = time.time()
+        for field, error in fetch_fields(fields, save_dir="."):
+            if error is not None:
+                raise error
+        timings["fetch"] = time.time() - start
+
+        start = time.time()
+        pixels = df_radec_to_pixel(catalog)
+        timings["radec"] = time.time() - start
+
+        n_detected = 0
+
+        for field in fields:
+
+            reference_image = fits_file_name(*field, band="r")
+
+            start = time.time()
+            images = align_field(*field, remove=False, method=method)
+            timings["align"] += time.time() - start
+
+            start = time.time()
+            detected = run_detection(
+                reference_image, remove=True, detector=detector
+            )
+            timings["detect"] += time.time() - start
+            n_detected += len(detected)
+
+            rows = (pixels["field"] == field[3]).values
+            chunk = pixels[rows].reset_index(drop=True)
+            chunk["FILE"] = reference_image
+
+            start = time.time()
+            get_cutout(chunk, images, bands, align=(method == "stamp"))
+            timings["cutout"] += time.time() - start
+
+    finally:
+        os.chdir(cwd)
+        if environ is None:
+            os.environ.pop("CUTOUT_SDSS_URL", None)
+        else:
+            os.environ["CUTOUT_SDSS_URL"] = environ
+        field_wcs.cache_clear()
+        server.shutdown()
+        server.server_close()
+
+    total = sum(timings.values())
+
+    return {
+        "config": {
+            "fields": n_fields,
+            "sources": n_sources,
+            "shape": list(shape),
+            "method": method,
+            "detector": detector
+        },
+        "stages": timings,
+        "total": total,
+        "objects": len(catalog),
+        "detected": n_detected,
+        "objects_per_second": len(catalog) / max(total, 1e-9),
+        "fields_per_second": n_fields / max(total, 1e-9),
+        "peak_rss_mb": peak_rss()
+    }
+
+
+def write_results(results, filename):
+    """
+    Writes the results of run_benchmark to a JSON file, which can be
+    used as a baseline by later runs.
+    """
+
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def print_results(results, baseline=None):
+    """
+    Prints the time of each stage and the throughput, and the relative
+    change from a baseline (a dictionary from a previous run) if given.
+    """
+
+    def change(new, old):
+        if baseline is None or not old:
+            return ""
+        return "{0:+.1f}%".format(100.0 * (new - old) / old)
+
+    old_stages = baseline["stages"] if baseline is not None else {}
+
+    print("{0:<10} {1:>10} {2:>10}".format("stage", "seconds", "change"))
+
+    for stage in STAGES:
+        seconds = results["stages"][stage]
+        print(
+            "{0:<10} {1:>10.3f} {2:>10}".format(
+                stage, seconds, change(seconds, old_stages.get(stage))
+            )
+        )
+
+    for key, fmt in [
+        ("total", "{0:.3f} s"),
+        ("objects_per_second", "{0:.1f}"),
+        ("fields_per_second", "{0:.3f}"),
+        ("peak_rss_mb", "{0:.1f} MB")]:
+        value = results[key]
+        old = baseline.get(key) if baseline is not None else None
+        print(
+            "{0:<20} {1:>12} {2:>10}".format(
+                key, fmt.format(value), change(value, old)
+            )
+        )
+
+    if baseline is not None and baseline.get("config") != results["config"]:
+        print("Warning: the baseline was run with a different configuration.")
+
+    return None
@@ -0,0 +1,246 @@
+import os
+import threading
+from cutout import metrics
+from cutout.sdss import fits_file_name, fetch_fields, valid_fits
+
+
+_default_cache = None
+
+
+def parse_size(size):
+    """
+    Converts a size such as '500M' or '20G' to a number of bytes.
+    """
+
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+    size = str(size).strip().upper().rstrip("B")
+
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(size)
+
+
+def default_cache():
+    """
+    Returns the frame cache configured by the CUTOUT_CACHE_DIR and
+    CUTOUT_CACHE_SIZE environment variables, or None if
+    CUTOUT_CACHE_DIR is not set.
+    """
+
+    global _default_cache
+
+    root = os.environ.get("CUTOUT_CACHE_DIR")
+
+    if root is None:
+        return None
+
+    if _default_cache is None or _default_cache.root != os.path.abspath(root):
+        _default_cache = FrameCache(
+            root, max_bytes=os.environ.get("CUTOUT_CACHE_SIZE")
+        )
+
+    return _default_cache
+
+
+class FrameCache(object):
+    """
+    A shared on-disk cache of uncompressed SDSS frames.
+
+    Frames are stored as <root>/<rerun>/<run>/<camcol>/<frame file name>,
+    so the path is determined by (rerun, run, camcol, field, band).
+    When the cache grows beyond max_bytes, the least recently used
+    frames are evicted. A field is downloaded under an exclusive file
+    lock, so several processes asking for the same field download it
+    only once.
+    """
+
+    def __init__(self, root, max_bytes=None):
+
+        if max_bytes is None:
+            max_bytes = 20 * 1024 ** 3
+
+        self.root = os.path.abspath(root)
+        self.max_bytes = parse_size(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._locks = {}
+        self._lock = threading.Lock()
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    def path(self, rerun, run, camcol, field, band):
+        """
+        Returns the path of a frame in the cache.
+        """
+
+        return os.path.join(
+            self.root, str(rerun), str(run), str(camcol),
+            fits_file_name(rerun, run, camcol, field, band)
+        )
+
+    def fetch(self, rerun, run, camcol, field,
+        bands='ugriz', base_url=None, ntry=10):
+        """
+        Returns the cached paths of all bands of a field, downloading
+        the bands that are not in the cache.
+
+        Returns
+        -------
+        A list of strings.
+        """
+
+        bands = [b for b in bands]
+        paths = [self.path(rerun, run, camcol, field, b) for b in bands]
+
+        if all(valid_fits(p) for p in paths):
+            self._touch(paths)
+            self.hits += len(paths)
+            metrics.count("cache_hits", len(paths))
+            return paths
+
+        field_dir = os.path.dirname(paths[0])
+        os.makedirs(field_dir, exist_ok=True)
+
+        lock_path = os.path.join(
+            field_dir, "frame-{0:06d}-{1}-{2:04d}.lock".format(run, camcol, field)
+        )
+
+        with self._field_lock(lock_path):
+
+            missing = [b for b, p in zip(bands, paths) if not valid_fits(p)]
+
+            self.hits += len(bands) - len(missing)
+            self.misses += len(missing)
+            metrics.count("cache_hits", len(bands) - len(missing))
+            metrics.count("cache_misses", len(missing))
+
+            if missing:
+                fields = [(rerun, run, camcol, field)]
+                for _, error in fetch_fields(
+                    fields, base_url=base_url, bands=missing,
+                    ntry=ntry, save_dir=field_dir):
+                    if error is not None:
+                        raise error
+
+            self._touch(paths)
+
+        if missing:
+            self.evict(keep=paths)
+
+        return paths
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently used frames until the cache fits
+        in max_bytes. Frames in keep are never removed.
+        Returns the number of bytes removed.
+        """
+
+        keep = set(keep)
+        frames = []
+
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(".fits"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                if path in keep:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                frames.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in frames)
+        total += sum(os.path.getsize(p) for p in keep if os.path.exists(p))
+        removed = 0
+
+        for _, size, path in sorted(frames):
+
+            if total - removed <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+                removed += size
+            except OSError:
+                pass
+
+        return removed
+
+    def stats(self):
+        """
+        Returns the hit and miss counters of this cache.
+        """
+
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _touch(self, paths):
+        # the modification time records the last use of a frame.
+        for path in paths:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+    def _field_lock(self, lock_path):
+
+        with self._lock:
+            if lock_path not in self._locks:
+                self._locks[lock_path] = _FileLock(lock_path)
+
+        return self._locks[lock_path]
+
+
+class _FileLock(object):
+    """
+    An exclusive lock that is held across threads and processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+
+        import fcntl
+
+        self._thread_lock.acquire()
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+
+        return self
+
+    def __exit__(self, *args):
+
+        import fcntl
+
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+        self._thread_lock.release()
+
+
+def link_frame(source, destination):
+    """
+    Makes a cached frame available at destination without copying it.
+    A hard link is used where possible, so the frame survives eviction
+    while it is in use, and a symbolic link otherwise.
+    """
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        if not os.path.exists(source):
+            raise
+        os.symlink(os.path.abspath(source), destination)
+
+    return destination
@@ -1,70 +1,231 @@
+import hashlib
+import mmap
 import os
+import queue
 import random
 import shutil
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
 from astropy.io import fits
-from cutout.utils import nanomaggie_to_luptitude, align_images
+from astropy import wcs
+from cutout.utils import (
+    nanomaggie_to_luptitude, align_images, reproject_stamps,
+    encode_images, IMAGE_DTYPES
+)
 from cutout.sdss import (
-    fits_file_name, single_field_image, df_radec_to_pixel, read_match_csv
+    fits_file_name, single_field_image, df_radec_to_pixel, valid_fits
 )
 from cutout.sex import run_sex
+from cutout.store import (
+    ChunkedWriter, read_index, partition_catalog, read_partition,
+    present_objids, save_records, merge_records, append_to_dataset,
+    build_index
+)
+from cutout.manifest import JobManifest
+from cutout import metrics, scratch
 
 
-def get_cutout(catalog, images, bands, size=64):
+def get_cutout(catalog, images, bands, size=64, align=False):
     """
     Takes a pandas dataframe with columns 'XPEAK_IMAGE' and 'YPEAK_IMAGE'
     and saves cutout images in save_dir.
 
+    Each band image is opened once (see read_frame), and all stamps are
+    gathered from it in a single vectorized operation. The result is
+    computed in float32 throughout.
+
+    If align is True, the images are not registered, and each stamp is
+    resampled from its own band onto the grid of the reference image
+    ('FILE') using the WCS of both images.
+
     Parameters
     ----------
     catalog: A pandas dataframe.
-    images: A list of strings.
+    images: A list of strings (file names) or 2-d numpy arrays.
     bands: A list of strings.
+    size: An integer, or a list of integers to cut out stamps of
+        several sizes from the same images.
+    align: A boolean.
 
     Returns
     -------
-    A numpy array.
+    A numpy array, or a list of numpy arrays (one per size) if size
+    is a list.
     """
 
-    array = np.zeros((len(catalog), len(bands), size, size))
-    coord = pd.DataFrame()
+    sizes = size if isinstance(size, (list, tuple)) else [size]
+
+    arrays = [
+        np.zeros((len(catalog), len(bands), s, s), dtype=np.float32)
+        for s in sizes
+    ]
+
+    if len(catalog) > 0:
+        with metrics.timer("cutout"):
+            _cut_out_sizes(catalog, images, bands, sizes, arrays, align)
+
+    if isinstance(size, (list, tuple)):
+        return arrays
+
+    return arrays[0]
+
+
+def _cut_out_sizes(catalog, images, bands, sizes, arrays, align):
+
+    loaded = {}
+
+    def load(image):
+        if not isinstance(image, str):
+            return np.asarray(image)
+        if image not in loaded:
+            loaded[image] = read_frame(
+                image, len(catalog) * len(sizes), max(sizes)
+            )
+        return loaded[image]
+
+    files = catalog["FILE"].values
+    references = pd.unique(files)
+
+    # the reference image only determines the bounds of each cutout.
+    corners = []
+
+    for size in sizes:
+
+        up = np.zeros(len(catalog), dtype=np.intp)
+        right = np.zeros(len(catalog), dtype=np.intp)
+
+        for reference in references:
+            rows = files == reference
+            up[rows], right[rows] = cutout_corners(
+                catalog.loc[rows, "XPEAK_IMAGE"].values,
+                catalog.loc[rows, "YPEAK_IMAGE"].values,
+                load(reference).shape,
+                size
+            )
+
+        corners.append((up, right))
 
-    for irow, row in catalog.iterrows():
+    for iband, band in enumerate(bands):
 
-        xpeak, ypeak = row[["XPEAK_IMAGE", "YPEAK_IMAGE"]].values
+        image = images[iband]
+        image_data = load(image)
 
-        reference = row["FILE"]
+        resample = (
+            align and isinstance(image, str) and image not in set(references)
+        )
+
+        if resample:
+            image_wcs = wcs.WCS(fits.getheader(image), relax=False)
+            reference_wcs = dict(
+                (reference, wcs.WCS(fits.getheader(reference), relax=False))
+                for reference in references
+            )
 
-        image_data = fits.getdata(reference)
+        for size, (up, right), array in zip(sizes, corners, arrays):
 
-        ymax, xmax = image_data.shape
+            if resample:
+                cut_out = np.empty(
+                    (len(catalog), size, size), dtype=np.float32
+                )
+                for reference in references:
+                    rows = files == reference
+                    cut_out[rows] = reproject_stamps(
+                        image_data, image_wcs, reference_wcs[reference],
+                        up[rows], right[rows], size
+                    )
+            else:
+                cut_out = extract_stamps(image_data, up, right, size)
+
+            nanomaggie_to_luptitude(cut_out, band, out=array[:, iband, :, :])
+
+    return None
+
+
+def cutout_corners(xpeak, ypeak, shape, size=64):
+    """
+    Returns the (up, right) corners of size x size cutouts centered on
+    the peak positions, shifted inwards where a cutout would fall off
+    the edge of an image with the given shape.
+
+    Parameters
+    ----------
+    xpeak: A numpy array.
+    ypeak: A numpy array.
+    shape: A tuple of (int, int).
+    size: An integer.
+
+    Returns
+    -------
+    A tuple of numpy arrays.
+    """
+
+    ymax, xmax = shape
+
+    right = (np.asarray(xpeak) - size // 2).astype(np.intp)
+    up = (np.asarray(ypeak) - size // 2).astype(np.intp)
+
+    right = np.clip(right, 0, xmax - size)
+    up = np.clip(up, 0, ymax - size)
+
+    return up, right
+
+
+def extract_stamps(image_data, up, right, size=64):
+    """
+    Gathers size x size stamps whose upper-left corners are (up, right)
+    from a 2-d image, using a strided window view and fancy indexing.
+
+    Returns
+    -------
+    A numpy array of shape (len(up), size, size).
+    """
+
+    image_data = np.asarray(image_data)
+    ymax, xmax = image_data.shape
+    sy, sx = image_data.strides
+
+    windows = np.lib.stride_tricks.as_strided(
+        image_data,
+        shape=(ymax - size + 1, xmax - size + 1, size, size),
+        strides=(sy, sx, sy, sx),
+        writeable=False
+    )
+
+    return windows[up, right]
+
+
+def read_frame(image, n_stamps=None, size=64, max_fraction=0.5):
+    """
+    Opens a FITS image to cut out n_stamps stamps of size x size pixels.
 
-        right = xpeak - size // 2
-        left = right + size
-        
-        if right < 0:
-            right, left = 0, size
-        if left > xmax:
-            right, left = xmax - size, xmax
+    The image is memory-mapped, so gathering a few stamps only reads the
+    pages under them. Each row of a stamp touches at least one page, so
+    when the stamps would touch more than max_fraction of the image,
+    reading it whole in one sequential pass is cheaper, and the image is
+    loaded into memory instead. With n_stamps=None, it is always loaded.
 
-        up = ypeak - size // 2
-        down = up + size
+    Returns
+    -------
+    A 2-d numpy array.
+    """
 
-        if up < 0:
-            up, down = 0, size
-        if down > ymax:
-            up, down = ymax - size, ymax
+    data = fits.getdata(image, memmap=True)
 
-        for iband, band in enumerate(bands):
+    if n_stamps is not None:
+        row_bytes = size * data.dtype.itemsize
+        pages = (row_bytes + mmap.PAGESIZE - 1) // mmap.PAGESIZE + 1
+        touched = n_stamps * size * pages * mmap.PAGESIZE
+        if touched <= max_fraction * data.nbytes:
+            metrics.count("sparse_frame_reads", 1)
+            return data
 
-            image_data = fits.getdata(images[iband])
-            cut_out = image_data[up: down, right: left]
-            cut_out = nanomaggie_to_luptitude(cut_out, band)
-            array[irow, iband, :, :] = cut_out
+    metrics.count("full_frame_reads", 1)
 
-    return array.astype(np.float32)
+    return np.array(data)
 
 
 def get_registered_images(rerun, run, camcol, field, bands=None):
@@ -91,9 +252,40 @@ def get_registered_images(rerun, run, camcol, field, bands=None):
     return registered_images
 
 
-def fetch_align(rerun, run, camcol, field, bands=None, remove=True):
+def fetch_align(rerun, run, camcol, field, bands=None, remove=True,
+    cache=None, method="montage"):
     """
     Run fetch and align (but not extract) in a single field.
+
+    The frames are read through the frame cache if one is configured,
+    and remove only deletes the working copies.
+
+    With method="numpy", the images are aligned in memory, and the
+    returned list holds arrays instead of registered file names
+    (the reference image is still a file name).
+
+    With method="stamp", the images are only fetched, and the original
+    file names are returned. They are aligned one stamp at a time by
+    get_cutout(..., align=True), and are not removed here.
+    """
+
+    registered_images = get_registered_images(
+        rerun, run, camcol, field, bands=bands
+    )
+
+    if method != "montage" or not all(
+        valid_fits(i) for i in registered_images):
+        single_field_image(rerun, run, camcol, field, cache=cache)
+
+    return align_field(
+        rerun, run, camcol, field, bands=bands, remove=remove, method=method
+    )
+
+
+def align_field(rerun, run, camcol, field, bands=None, remove=True,
+    method="montage"):
+    """
+    Align the fetched images of a single field. See fetch_align.
     """
 
     if bands is None:
@@ -106,23 +298,30 @@ def fetch_align(rerun, run, camcol, field, bands=None, remove=True):
 
     reference_image = fits_file_name(rerun, run, camcol, field, 'r')
 
-    registered_images = [
-        image.replace(".fits", ".registered.fits")
-        if image != reference_image else reference_image
-        for image in original_images
-    ]
+    registered_images = get_registered_images(
+        rerun, run, camcol, field, bands=bands
+    )
 
-    if not all(os.path.exists(i) for i in registered_images):
+    if method == "stamp":
+        return original_images
 
-        try:
-            single_field_image(rerun, run, camcol, field)
-            align_images(original_images, reference_image)
-            print("{}-{}-{}-{}: Aligned.".format(rerun, run, camcol, field))
-        except:
-            raise
+    if method != "montage":
+        registered_images = align_images(
+            original_images, reference_image, method=method
+        )
+        print("{}-{}-{}-{}: Aligned.".format(rerun, run, camcol, field))
+
+    elif not all(valid_fits(i) for i in registered_images):
+        align_images(original_images, reference_image)
+        print("{}-{}-{}-{}: Aligned.".format(rerun, run, camcol, field))
 
     if remove:
-        images = [i for i in original_images if i != reference_image]
+        # bands that were already aligned are returned as their files.
+        kept = [i for i in registered_images if isinstance(i, str)]
+        images = [
+            i for i in original_images
+            if i != reference_image and i not in kept
+        ]
         for image in images:
             if os.path.exists(image):
                 os.remove(image)
@@ -131,171 +330,599 @@ def fetch_align(rerun, run, camcol, field, bands=None, remove=True):
 
 
 def fetch_align_sex(rerun, run, camcol, field,
-    bands=None, reference_band='r', remove=True):
+    bands=None, reference_band='r', remove=True, method="montage",
+    detector="sex", size=64, save_dir="result"):
     """
     Run fetch, align, and sex in a single field.
     """
 
+    registered_images = fetch_align(
+        rerun, run, camcol, field, remove=remove, method=method
+    )
+    reference_image = fits_file_name(rerun, run, camcol, field, 'r')
+
+    catalog = run_detection(reference_image, remove=remove, detector=detector)
+
+    sex_cutout(
+        catalog, registered_images, reference_image,
+        bands=bands, remove=remove, method=method, size=size,
+        save_dir=save_dir
+    )
+
+
+def run_detection(reference_image, remove=True, detector="sex"):
+    """
+    Detects the sources in the reference image.
+
+    With detector="sex", SExtractor is run on the file. With
+    detector="numpy", cutout.detect.detect_sources is used instead,
+    which needs SciPy but no external program.
+
+    Returns
+    -------
+    A pandas dataframe with 'XPEAK_IMAGE', 'YPEAK_IMAGE' and 'FILE'.
+    """
+
+    if detector == "numpy":
+        from cutout.detect import detect_sources
+        return detect_sources(reference_image)
+
+    if detector != "sex":
+        raise ValueError("Unknown detector: {}".format(detector))
+
+    return run_sex(reference_image, remove=remove)
+
+
+def sex_cutout(catalog, registered_images, reference_image,
+    bands=None, remove=True, method="montage", batch_size=4096, size=64,
+    save_dir="result"):
+    """
+    Cuts out the objects in a SExtractor catalog and saves them in
+    <save_dir>/<reference image>.npy.
+
+    The cutouts are made batch_size objects at a time and appended to
+    memory-mapped chunks, so memory does not grow with the number of
+    detections. After a crash, the batches that were already written
+    are skipped, if the catalog is the same. If size is a list, the
+    cutouts of each size are saved in <save_dir>/<size>/ (see
+    output_dirs).
+    """
+
     if bands is None:
         bands = [b for b in "ugriz"]
 
-    registered_images = fetch_align(rerun, run, camcol, field, remove=remove)
-    reference_image = [i for i in registered_images if 'registered' not in i][0]
+    outputs = output_dirs(save_dir, size)
+    sizes = [s for s, _ in outputs]
+
+    # each band is read once for all batches and sizes.
+    if method != "stamp":
+        images = [
+            read_frame(image, len(catalog) * len(sizes), max(sizes))
+            if isinstance(image, str) else image
+            for image in registered_images
+        ]
+    else:
+        images = registered_images
 
-    catalog = run_sex(reference_image, remove=remove)
+    catalog_key = "{}-{}".format(
+        len(catalog),
+        hashlib.sha1(
+            pd.util.hash_pandas_object(catalog, index=False).values
+        ).hexdigest()
+    )
 
-    result = get_cutout(catalog, registered_images, bands)
+    filenames = []
+    writers = []
+    prefixes = []
+
+    for size_, output_dir in outputs:
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        filename = os.path.join(
+            output_dir, reference_image.replace(".fits", ".npy")
+        )
+
+        # each batch is recorded as '<catalog>:<bands>:<size>/<start>'.
+        prefix = "{}:{}:{}/".format(catalog_key, "".join(bands), size_)
+
+        # a partial result is redone if the catalog has changed.
+        if os.path.exists(filename + ".part") and not _resumable(
+            filename + ".part", prefix, batch_size, len(catalog)):
+            shutil.rmtree(filename + ".part")
+
+        filenames.append(filename)
+        prefixes.append(prefix)
+        writers.append(ChunkedWriter(
+            filename + ".part", np.float32, shape=(len(bands), size_, size_),
+            chunk_size=batch_size
+        ))
+
+    for start in range(0, len(catalog), batch_size):
+        todo = [
+            i for i, (writer, prefix) in enumerate(zip(writers, prefixes))
+            if prefix + str(start) not in writer.completed
+        ]
+        if not todo:
+            continue
+        batch = catalog.iloc[start: start + batch_size]
+        batch = batch.reset_index(drop=True)
+        cutouts = get_cutout(
+            batch, images, bands, size=[sizes[i] for i in todo],
+            align=(method == "stamp")
+        )
+        for i, cutout in zip(todo, cutouts):
+            writers[i].append(cutout, key=prefixes[i] + str(start))
 
     if remove:
-        for image in registered_images:
-            if os.path.exists(image):
-                os.remove(image)
+        remove_images(registered_images)
+
+    for writer, filename in zip(writers, filenames):
+        writer.finalize(filename)
 
-    filename = os.path.join("result", reference_image.replace(".fits", ".npy"))
 
-    if not os.path.exists("result"):
-        os.makedirs("result")
+def _resumable(path, prefix, batch_size, n_objects):
+    """
+    Returns True if the ChunkedWriter directory in path holds the first
+    batches of sex_cutout for the batch keys starting with prefix.
+    """
 
-    np.save(filename, result)
+    if not os.path.exists(os.path.join(path, "index.json")):
+        return False
 
+    index = read_index(path)
+    length = sum(chunk["count"] for chunk in index["chunks"])
 
-def fetch_align_match(df, filename,
-    bands=None, size=64, remove=True, save_dir="result"):
+    return (
+        index["chunk_size"] == batch_size
+        and all(key.startswith(prefix) for key in index["completed"])
+        and length == min(len(index["completed"]) * batch_size, n_objects)
+    )
+
+
+def output_dirs(save_dir, size):
     """
-    Match.
+    Returns a list of (size, directory) tuples. A single size is saved
+    in save_dir, and each of several sizes in save_dir/<size>.
     """
-    
-    if bands is None:
-        bands = [b for b in "ugriz"]
 
-    groups = df.groupby(["rerun", "run", "camcol", "field"]).groups
+    if not isinstance(size, (list, tuple)):
+        return [(int(size), save_dir)]
+
+    if len(size) == 1:
+        return [(int(size[0]), save_dir)]
+
+    return [(int(s), os.path.join(save_dir, str(s))) for s in size]
+
+
+def match_dtype(df, bands, size=64, image_dtype="float32"):
+    """
+    Returns the structured dtype of the match mode output.
+
+    The images are stored as float32, float16 or uint16 (image_dtype).
+    uint16 images have an offset and a scale per band
+    (see cutout.utils.encode_images and decode_images).
+    """
+
+    if image_dtype not in IMAGE_DTYPES:
+        raise ValueError("Unknown image dtype '{}'.".format(image_dtype))
 
     dtype = [
         ("objID", "u8"), # unsigned integer
-        ("image", "f4", (len(bands), size, size)) # 4-byte float
+        ("image", image_dtype, (len(bands), size, size))
     ]
+    if image_dtype == "uint16":
+        dtype += [("offset", "f4", (len(bands),))]
+        dtype += [("scale", "f4", (len(bands),))]
+
     if "class" in df.columns:
         dtype += [("class", "U8")] # 8-character unicode string
 
     if "z" in df.columns:
         dtype += [("z", "f4")] # 4-byte float
-       
-    result = np.zeros(len(df), dtype=dtype)
 
-    count = 0
+    return dtype
+
+
+def match_field(df, registered_images, field,
+    bands=None, size=64, method="montage", image_dtype="float32"):
+    """
+    Cuts out the objects of a single field in a match catalog.
+
+    Returns
+    -------
+    A structured numpy array with the dtype of match_dtype, or a list
+    of them (one per size) if size is a list.
+    """
+
+    if bands is None:
+        bands = [b for b in "ugriz"]
+
+    reference_image = fits_file_name(*field, band='r')
+
+    catalog = df_radec_to_pixel(df)
+    catalog = catalog.reset_index(drop=True)
+    catalog["FILE"] = reference_image
+
+    sizes = size if isinstance(size, (list, tuple)) else [size]
+
+    cutouts = get_cutout(
+        catalog, registered_images, bands, size=sizes,
+        align=(method == "stamp")
+    )
+
+    results = []
+
+    for size_, cutout in zip(sizes, cutouts):
+
+        result = np.zeros(
+            len(catalog), dtype=match_dtype(df, bands, size_, image_dtype)
+        )
+
+        images, offset, scale = encode_images(cutout, image_dtype)
+
+        result["objID"] = catalog["objID"]
+        result["image"] = images
+
+        if offset is not None:
+            result["offset"] = offset
+            result["scale"] = scale
+
+        if "class" in catalog.columns:
+            result["class"] = catalog["class"]
+        if "z" in catalog.columns:
+            result["z"] = catalog["z"]
+
+        results.append(result)
+
+    if isinstance(size, (list, tuple)):
+        return results
+
+    return results[0]
+
+
+def fetch_align_match(df, filename,
+    bands=None, size=64, remove=True, save_dir="result", method="montage",
+    chunk_size=256, image_dtype="float32"):
+    """
+    Match.
+
+    The cutouts of each field are appended to memory-mapped chunks in
+    '<save_dir>/<filename>.part' as soon as the field is done, so memory
+    does not grow with the number of objects, and a rerun after a crash
+    skips the fields that were already written. The chunks are combined
+    into '<save_dir>/<filename>' at the end, only if every field
+    succeeded; otherwise they are kept for the next run, so a failed
+    field never leaves a result file behind. A catalog of a single
+    field (as in match_group) is written to '<save_dir>/<filename>'
+    directly, without chunks. The images are stored as
+    image_dtype (see match_dtype). If size is a list, the cutouts of each
+    size are written to '<save_dir>/<size>/<filename>' (see output_dirs).
+
+    Returns
+    -------
+    A list of (field, error) tuples for the fields that failed.
+    """
+    
+    if bands is None:
+        bands = [b for b in "ugriz"]
+
+    groups = df.groupby(["rerun", "run", "camcol", "field"]).groups
+
+    outputs = output_dirs(save_dir, size)
+    sizes = [s for s, _ in outputs]
+    writers = []
+
+    # saves the metadata operations of a chunk directory, which may be
+    # on a shared file system, for what would be a single append.
+    single = len(groups) == 1
+
+    for size_, output_dir in outputs:
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        if single:
+            continue
+
+        writers.append(ChunkedWriter(
+            os.path.join(output_dir, filename + ".part"),
+            match_dtype(df, bands, size_, image_dtype),
+            chunk_size=chunk_size
+        ))
+
+    failed = []
 
     for field, index in groups.items():
 
-        try:
-            registered_images = fetch_align(*field, remove=remove)
+        key = "{0}-{1}-{2}-{3}".format(*field)
 
-            reference_image = [i for i in registered_images if 'registered' not in i][0]
+        if writers and all(key in writer.completed for writer in writers):
+            continue
 
-            catalog = df_radec_to_pixel(df.loc[index, :])
-            catalog = catalog.reset_index(drop=True)
-            catalog["FILE"] = reference_image
+        with metrics.field(key):
 
-            cutout = get_cutout(catalog, registered_images, bands)
+            try:
+                registered_images = fetch_align(
+                    *field, remove=remove, method=method
+                )
 
-            result[count: count + len(catalog)]["objID"] = catalog["objID"]
-            result[count: count + len(catalog)]["image"] = cutout
+                records = match_field(
+                    df.loc[index, :], registered_images, field,
+                    bands=bands, size=sizes, method=method,
+                    image_dtype=image_dtype
+                )
 
-            if "class" in catalog.columns:
-                result[count: count + len(catalog)]["class"] = catalog["class"]
-            if "z" in catalog.columns:
-                result[count: count + len(catalog)]["z"] = catalog["z"]
+                if single:
+                    for (_, output_dir), records_ in zip(outputs, records):
+                        save_records(
+                            records_, os.path.join(output_dir, filename)
+                        )
 
-            count += len(catalog)
+                # after a crash, some sizes may already have the field.
+                for writer, records_ in zip(writers, records):
+                    if key not in writer.completed:
+                        writer.append(records_, key=key)
 
-            print("{0}-{1}-{2}-{3}: Sucessfully completed.".format(*field))
+                print(
+                    "{0}-{1}-{2}-{3}: Sucessfully completed.".format(*field)
+                )
 
-        except Exception as e:
-            rerun, run, camcol, field_ = field
-            print(
-                "{0}-{1}-{2}-{3}: {4}".format(rerun, run, camcol, field_, e)
-            )
-            registered_image = registered_images(rerun, run, camcol, field_)
+            except Exception as e:
+                rerun, run, camcol, field_ = field
+                print("{0}-{1}-{2}-{3}: {4}".format(
+                    rerun, run, camcol, field_, e
+                ))
+                registered_images = get_registered_images(
+                    rerun, run, camcol, field_
+                )
+                failed.append((field, e))
 
-        if remove:
-            for image in registered_images:
-                if os.path.exists(image):
-                    os.remove(image)
+            if remove:
+                remove_images(registered_images)
 
-    result = result[:count]
+    for writer, (_, output_dir) in zip(writers, outputs):
+        if failed:
+            writer.close()
+        else:
+            writer.finalize(os.path.join(output_dir, filename))
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    return failed
 
 
-    np.save(os.path.join(save_dir, filename), result)
+def remove_images(images):
+    """
+    Removes the image files in a list of file names and arrays.
+    """
 
-    return None
+    for image in images:
+        if isinstance(image, str) and os.path.exists(image):
+            os.remove(image)
 
 
-def sequential_match(filename, shuffle=True, remove=True):
+def sequential_match(filename, shuffle=True, remove=True, method="montage",
+    max_attempts=3, image_dtype="float32", size=64):
     """
     Sequential mode.
+
+    The state of each field is recorded in result/manifest.sqlite, so
+    a rerun only processes the fields that are pending, or that failed
+    fewer than max_attempts times. If CUTOUT_SCRATCH is set, the
+    partitioned catalog and the intermediate files are kept in a
+    scratch directory (see cutout.scratch), and only the results are
+    written to result/.
     """
 
-    groups = write_group_csv(filename)
-        
-    print("Sequential mode: Processing {} fields...\n".format(len(groups)))
+    run = metrics.start_run()
 
-    for group in groups:
+    filename = os.path.abspath(filename)
+    save_dir = os.path.abspath("result")
+    temp_dir = os.path.join(scratch.scratch_dir() or os.getcwd(), "temp")
 
-        npy_file = group.replace(".temp", ".npy")
-        if os.path.exists(os.path.join("result", npy_file)):
-            continue
+    groups, counts = partition_catalog(
+        filename, save_dir=temp_dir, return_counts=True
+    )
 
-        chunk = read_match_csv(os.path.join("temp", group))
-        field = group.replace("frame-", "").replace(".temp", "")
+    manifest = open_manifest(
+        groups, counts, save_dir=save_dir, size=size,
+        image_dtype=image_dtype
+    )
+    todo = manifest.todo(max_attempts)
 
-        print(
-            "{}: Processing {} object(s)...".format(field, len(chunk))
-        )
-        
-        npy_file = group.replace(".temp", ".npy")
+    if shuffle:
+        random.shuffle(todo)
 
-        try:
-            fetch_align_match(chunk, npy_file, remove=remove)
-            print("{}: Sucessfully completed.".format(field))
-        except Exception as e:
-            raise
+    print("Sequential mode: Processing {} fields...\n".format(len(todo)))
 
-    if remove:
-        clean_group_temp()
+    with scratch.working_dir():
+
+        for group in todo:
+
+            field = group.replace("frame-", "")
+
+            print(
+                "{}: Processing {} object(s)...".format(field, counts[group])
+            )
+
+            manifest.start(group)
+
+            try:
+                match_group(
+                    group, remove=remove, method=method,
+                    temp_dir=temp_dir, save_dir=save_dir,
+                    image_dtype=image_dtype, size=size
+                )
+                manifest.done(group)
+                print("{}: Sucessfully completed.".format(field))
+            except Exception as e:
+                manifest.fail(group, e)
+                print("{}: {}".format(field, e))
+
+    manifest.report()
+    metrics.report(run=run)
+
+    if remove and not manifest.todo(max_attempts=1):
+        clean_group_temp(temp_dir)
 
     return None
 
 
-def write_group_csv(filename, shuffle=True, save_dir="temp", skip_exists=True):
+def open_manifest(groups, counts, save_dir="result", size=64,
+    image_dtype="float32"):
     """
+    Opens the job manifest of a match run in save_dir and adds the groups.
+    On the first run, groups that already have a result (of every size)
+    are marked done. Raises a ValueError if the manifest was made for
+    other sizes or another image dtype (see JobManifest.check_config).
     """
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    outputs = output_dirs(save_dir, size)
 
-    df = read_match_csv(filename)
-    groups = df.groupby(["rerun", "run", "camcol", "field"]).groups
+    def exists(group):
+        return all(
+            check_npy_success(group + ".npy", output_dir)
+            for _, output_dir in outputs
+        )
 
-    group_list = []
+    manifest = JobManifest(os.path.join(save_dir, "manifest.sqlite"))
+    manifest.check_config({
+        "size": [s for s, _ in outputs],
+        "image_dtype": image_dtype
+    })
+    manifest.add(groups, counts, exists=exists)
 
-    for field, index in groups.items():
+    return manifest
 
-        rerun, run, camcol, field_ = field
-        fout = "frame-{}-{}-{}-{}.temp".format(rerun, run, camcol, field_)
-        group_list.append(fout)
 
-        file_path = os.path.join(save_dir, fout)
-        if skip_exists and os.path.exists(file_path):
-            continue
-        else:
-            df.loc[index, :].to_csv(file_path)
+def match_group(group, remove=True, method="montage",
+    temp_dir="temp", save_dir="result", image_dtype="float32", size=64):
+    """
+    Runs fetch_align_match on a single group of a partitioned catalog.
+    Raises an exception if the field failed.
 
-    if shuffle:
-        random.shuffle(group_list)
+    Returns
+    -------
+    The number of objects in the group.
+    """
+
+    chunk = read_partition(group, temp_dir)
+
+    failed = fetch_align_match(
+        chunk, group + ".npy", remove=remove, save_dir=save_dir, method=method,
+        image_dtype=image_dtype, size=size
+    )
 
-    return group_list
+    if failed:
+        raise failed[0][1]
+
+    return len(chunk)
+
+
+def incremental_match(filename, remove=True, method="montage",
+    image_dtype="float32", size=64, dataset=None, temp_dir="temp",
+    save_dir="result"):
+    """
+    Incremental mode.
+
+    Only the objects of the CSV file whose objIDs are not already in the
+    output are cut out, so a catalog that grows by a few objects costs
+    work in proportion to the new objects. The new objects are grouped
+    by field, and the records of each field are merged into
+    '<save_dir>/<group>.npy' (or '<save_dir>/<size>/<group>.npy'), or
+    appended to the sharded dataset in dataset (see consolidate) if it
+    is given. The partitioned catalog and the new records are kept in
+    temp_dir, which is in the scratch directory if CUTOUT_SCRATCH is set
+    (see cutout.scratch).
+
+    Returns
+    -------
+    A list of (field, error) tuples for the fields that failed.
+    """
+
+    filename = os.path.abspath(filename)
+    save_dir = os.path.abspath(save_dir)
+    temp_dir = os.path.join(scratch.scratch_dir() or os.getcwd(), temp_dir)
+
+    if dataset is not None:
+        dataset = os.path.abspath(dataset)
+
+    outputs = output_dirs(save_dir, size)
+
+    if dataset is not None and len(outputs) > 1:
+        raise ValueError("A dataset can only be updated with a single size.")
+
+    present = present_objids(
+        dataset if dataset is not None else outputs[0][1]
+    )
+
+    groups = partition_catalog(
+        filename, shuffle=False, save_dir=temp_dir, skip_exists=False
+    )
+
+    todo = []
+
+    for group in groups:
+        chunk = read_partition(group, temp_dir)
+        new = ~np.isin(chunk["objID"].values, present)
+        if new.any():
+            todo.append((group, chunk[new]))
+
+    print(
+        "Incremental mode: {} new object(s) in {} field(s), "
+        "{} object(s) already done.\n".format(
+            sum(len(chunk) for _, chunk in todo), len(todo), len(present)
+        )
+    )
+
+    delta_dir = os.path.join(temp_dir, "delta")
+    delta_outputs = output_dirs(delta_dir, size)
+    writer = None
+    failed = []
+
+    with scratch.working_dir():
+
+        for group, chunk in todo:
+
+            failed_ = fetch_align_match(
+                chunk, group + ".npy", remove=remove, save_dir=delta_dir,
+                method=method, image_dtype=image_dtype, size=size
+            )
+
+            if failed_:
+                failed += failed_
+                continue
+
+            for (_, delta), (_, output_dir) in zip(delta_outputs, outputs):
+
+                new_file = os.path.join(delta, group + ".npy")
+
+                if dataset is not None:
+                    writer = append_to_dataset(
+                        new_file, dataset,
+                        key="{}@{}".format(group, int(time.time()))
+                    )
+                else:
+                    if not os.path.exists(output_dir):
+                        os.makedirs(output_dir)
+                    merge_records(
+                        new_file, os.path.join(output_dir, group + ".npy")
+                    )
+
+    if writer is not None:
+        build_index(writer)
+
+    # the partitions are made again by every run.
+    if remove:
+        clean_group_temp(temp_dir)
+
+    print(
+        "Incremental mode: {} field(s) updated, {} failed.".format(
+            len(todo) - len(failed), len(failed)
+        )
+    )
+
+    return failed
 
 
 def check_npy_success(filename, save_dir="result"):
@@ -313,122 +940,723 @@ def clean_group_temp(save_dir="temp"):
         shutil.rmtree(save_dir)
 
 
-def parallel_match(filename, remove=True, chunksize=1000):
+def mpi_work_queue(comm, tasks, work, on_start=None, on_result=None):
     """
-    Parallel mode.
+    Runs work(task) for each task on the MPI ranks of comm.
+
+    Rank 0 hands out the tasks one at a time, in the given order,
+    to whichever rank asks for more work, and collects the status
+    of each task. With a single rank, rank 0 runs all tasks itself.
+
+    On rank 0, on_start(task) is called when a task is handed out,
+    and on_result(task, error) when its status comes back.
+
+    Returns
+    -------
+    On rank 0, a list of (task, error) tuples, where error is None
+    if the task succeeded. None on the other ranks.
     """
 
     from mpi4py import MPI
 
-    comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
     size = comm.Get_size()
 
+    tag_ready, tag_task, tag_stop = 1, 2, 3
+
+    if on_start is None:
+        on_start = lambda task: None
+
+    if on_result is None:
+        on_result = lambda task, error: None
+
+    if size == 1:
+        results = []
+        for task in tasks:
+            on_start(task)
+            results.append((task, _run_task(work, task, rank)))
+            on_result(*results[-1])
+        return results
+
+    status = MPI.Status()
+
     if rank == 0:
-        groups = write_group_csv(filename)
-        print("Parallel mode: Processing {} fields on {} cores...\n".format(len(groups), size))
-    else:
-        groups = None
 
-    groups = comm.bcast(groups, root=0)
-  
-    start = len(groups) // size * rank
-    end = len(groups) // size * (rank + 1)
+        tasks = list(tasks)
+        results = []
+        next_task = 0
+        active = size - 1
 
-    for group in groups[start: end]:
+        while active > 0:
 
-        npy_file = group.replace(".temp", ".npy")
+            message = comm.recv(
+                source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status
+            )
+            source = status.Get_source()
 
-        if check_npy_success(group):
-            continue
+            if message is not None:
+                results.append(message)
+                on_result(*message)
+
+            if next_task < len(tasks):
+                on_start(tasks[next_task])
+                comm.send(tasks[next_task], dest=source, tag=tag_task)
+                next_task += 1
+            else:
+                comm.send(None, dest=source, tag=tag_stop)
+                active -= 1
+
+        return results
+
+    comm.send(None, dest=0, tag=tag_ready)
+
+    while True:
+
+        task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+
+        if status.Get_tag() == tag_stop:
+            break
+
+        comm.send((task, _run_task(work, task, rank)), dest=0, tag=tag_ready)
 
-        chunk = read_match_csv(os.path.join("temp", group))
+    return None
+
+
+def _run_task(work, task, rank):
+
+    try:
+        work(task)
+    except Exception as e:
+        print("Core {0}: {1}".format(rank, e))
+        return str(e)
+
+    return None
+
+
+def parallel_match(filename, remove=True, chunksize=1000, method="montage",
+    max_attempts=3, image_dtype="float32", size=64):
+    """
+    Parallel mode.
+
+    Rank 0 schedules the fields, largest first, and records their state
+    in result/manifest.sqlite. The other ranks process one field at a
+    time as they become free. If CUTOUT_SCRATCH is set, each rank keeps
+    its intermediate files in its own scratch directory on its node
+    (see cutout.scratch). The partitioned catalog in temp/ is read by
+    all ranks, so it stays in the working directory.
+    """
+
+    from mpi4py import MPI
 
-        field = group.replace("frame-", "").replace(".temp", "")
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    n_cores = comm.Get_size()
+
+    # the ranks tag their events with the run id of rank 0.
+    run = comm.bcast(metrics.start_run() if rank == 0 else None, root=0)
+    metrics.start_run(run)
+
+    filename = os.path.abspath(filename)
+    temp_dir = os.path.abspath("temp")
+    save_dir = os.path.abspath("result")
 
+    if rank == 0:
+        groups, counts = partition_catalog(
+            filename, save_dir=temp_dir, return_counts=True
+        )
+        manifest = open_manifest(
+            groups, counts, save_dir=save_dir, size=size,
+            image_dtype=image_dtype
+        )
+        todo = manifest.todo(max_attempts)
+        todo.sort(key=lambda group: counts[group], reverse=True)
         print(
-            "{}: Processing {} object(s) on core {}..."
-            "".format(field, len(chunk), rank)
+            "Parallel mode: Processing {} fields on {} cores...\n"
+            "".format(len(todo), n_cores)
         )
-        
-        npy_file = group.replace(".temp", ".npy")
+        on_start = manifest.start
 
-        try:
-            fetch_align_match(chunk, npy_file, remove=remove)
-            print(
-                "{0}: Sucessfully completed on core {1}.".format(field, rank)
+        def on_result(group, error):
+            if error is None:
+                manifest.done(group)
+            else:
+                manifest.fail(group, error)
+    else:
+        todo, on_start, on_result = None, None, None
+
+    def process(group):
+
+        field = group.replace("frame-", "")
+
+        print("{}: Processing on core {}...".format(field, rank))
+
+        match_group(
+            group, remove=remove, method=method,
+            temp_dir=temp_dir, save_dir=save_dir,
+            image_dtype=image_dtype, size=size
+        )
+
+        print(
+            "{0}: Sucessfully completed on core {1}.".format(field, rank)
+        )
+
+    with scratch.working_dir():
+        mpi_work_queue(comm, todo, process, on_start, on_result)
+
+    if rank == 0:
+
+        manifest.report()
+        metrics.report(run=run)
+
+        if remove and not manifest.todo(max_attempts=1):
+            clean_group_temp(temp_dir)
+
+    return None
+
+
+def local_parallel_match(filename, workers=None, remove=True,
+    method="montage", work_dir="work", max_attempts=3,
+    image_dtype="float32", size=64):
+    """
+    Parallel mode on a single node, without MPI.
+
+    The fields are processed by a pool of worker processes, largest
+    first. Each worker runs in its own directory under work_dir, so the
+    intermediate files of different workers do not collide. If
+    CUTOUT_SCRATCH is set, the partitioned catalog and the worker
+    directories are in a scratch directory instead (see cutout.scratch).
+    As in sequential_match, the state of each field is recorded in
+    result/manifest.sqlite, and a rerun only processes what is left.
+    """
+
+    run = metrics.start_run()
+
+    filename = os.path.abspath(filename)
+    save_dir = os.path.abspath("result")
+    work_dir = os.path.abspath(work_dir)
+
+    # the scratch directories of the workers are made inside this one.
+    temp_dir = os.path.join(scratch.scratch_dir() or os.getcwd(), "temp")
+
+    groups, counts = partition_catalog(
+        filename, save_dir=temp_dir, return_counts=True
+    )
+
+    manifest = open_manifest(
+        groups, counts, save_dir=save_dir, size=size,
+        image_dtype=image_dtype
+    )
+    todo = manifest.todo(max_attempts)
+    todo.sort(key=lambda group: counts[group], reverse=True)
+
+    print(
+        "Local parallel mode: Processing {} fields on {} workers...\n"
+        "".format(len(todo), workers or os.cpu_count())
+    )
+
+    start = time.time()
+    n_objects = 0
+    failed = []
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_local_worker,
+        initargs=(work_dir,)) as executor:
+
+        futures = {}
+
+        for group in todo:
+            manifest.start(group)
+            future = executor.submit(
+                _local_match_task, group, temp_dir, save_dir, remove, method,
+                image_dtype, size
             )
-        except Exception as e:
+            futures[future] = group
+
+        for i, future in enumerate(as_completed(futures)):
+
+            group = futures[future]
+            field = group.replace("frame-", "")
+
+            try:
+                elapsed = future.result()
+                manifest.done(group, elapsed)
+                n_objects += counts[group]
+                status = "Sucessfully completed"
+            except Exception as e:
+                manifest.fail(group, e)
+                failed.append(group)
+                status = "Failed ({})".format(e)
+
+            elapsed = time.time() - start
+
             print(
-                "Core {0}: {1}".format(rank, e)
+                "[{0}/{1}] {2}: {3}. {4:.1f} objects/s.".format(
+                    i + 1, len(todo), field, status, n_objects / elapsed
+                )
             )
 
-    if remove and all(check_npy_success(group) for group in groups):
-        clean_group_temp()
+    elapsed = time.time() - start
+
+    print(
+        "\nLocal parallel mode: {0} fields completed, {1} failed, "
+        "{2} objects in {3:.1f} s ({4:.2f} fields/s, {5:.1f} objects/s)."
+        "".format(
+            len(todo) - len(failed), len(failed), n_objects, elapsed,
+            (len(todo) - len(failed)) / max(elapsed, 1e-9),
+            n_objects / max(elapsed, 1e-9)
+        )
+    )
+
+    manifest.report()
+    metrics.report(run=run)
+
+    if remove and not manifest.todo(max_attempts=1):
+        clean_group_temp(temp_dir)
+        clean_group_temp(work_dir)
 
     return None
 
 
-def sequential_sex(df, remove=True):
+def _init_local_worker(work_dir):
+
+    worker_dir = scratch.scratch_dir()
+
+    if worker_dir is None:
+        worker_dir = os.path.join(work_dir, "worker-{}".format(os.getpid()))
+
+    if not os.path.exists(worker_dir):
+        os.makedirs(worker_dir)
+
+    os.chdir(worker_dir)
+
+
+def _local_match_task(group, temp_dir, save_dir, remove, method,
+    image_dtype="float32", size=64):
+
+    start = time.time()
+
+    match_group(
+        group, remove=remove, method=method,
+        temp_dir=temp_dir, save_dir=save_dir, image_dtype=image_dtype,
+        size=size
+    )
+
+    return time.time() - start
+
+
+def run_pipeline(items, stages, queue_size=2, max_in_flight=4, poll=None):
     """
-    Sequential mode.
+    Runs items through a sequence of stages, each with its own pool of
+    worker threads. The stages are connected by bounded queues, so a
+    slow stage holds back the stages before it, and at most
+    max_in_flight items are between the first and the last stage.
+
+    This is a generator that yields (item, result, error) as items
+    leave the last stage. If a stage raises, the item skips the
+    remaining stages and error is the exception.
+
+    Parameters
+    ----------
+    items: An iterable.
+    stages: A list of (function, number of workers) tuples.
+        The first function is called with the item, and each following
+        function with the return value of the previous one.
+    queue_size: Maximum number of items waiting for each stage.
+    max_in_flight: Maximum number of items in the pipeline.
+    poll: A function that is called in the caller's thread about once
+        a second while waiting for items to leave the last stage.
+    """
+
+    stop = object()
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    queues.append(queue.Queue())
+
+    in_flight = threading.Semaphore(max_in_flight)
+    closed = threading.Event()
+    remaining = [n_workers for _, n_workers in stages]
+    lock = threading.Lock()
+
+    def feed():
+        for item in items:
+            in_flight.acquire()
+            if closed.is_set():
+                break
+            queues[0].put((item, item, None))
+        for _ in range(stages[0][1]):
+            queues[0].put(stop)
+
+    def work(istage):
+        function, _ = stages[istage]
+        while True:
+            message = queues[istage].get()
+            if message is stop:
+                break
+            item, value, error = message
+            if error is None:
+                try:
+                    value = function(value)
+                except Exception as e:
+                    value, error = None, e
+            queues[istage + 1].put((item, value, error))
+        with lock:
+            remaining[istage] -= 1
+            last = remaining[istage] == 0
+        if last:
+            n_next = stages[istage + 1][1] if istage + 1 < len(stages) else 1
+            for _ in range(n_next):
+                queues[istage + 1].put(stop)
+
+    threads = [threading.Thread(target=feed)]
+    for istage, (_, n_workers) in enumerate(stages):
+        threads += [
+            threading.Thread(target=work, args=(istage,))
+            for _ in range(n_workers)
+        ]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            if poll is None:
+                message = queues[-1].get()
+            else:
+                try:
+                    message = queues[-1].get(timeout=1)
+                except queue.Empty:
+                    poll()
+                    continue
+            if message is stop:
+                break
+            in_flight.release()
+            yield message
+    finally:
+        # wakes up the feeder if the caller stops early.
+        closed.set()
+        in_flight.release()
+
+
+def pipeline_match(filename, remove=True, method="montage",
+    fetch_workers=4, align_workers=2, cutout_workers=2, max_fields=8,
+    max_attempts=3, image_dtype="float32", size=64):
+    """
+    Pipelined mode.
+
+    Fetching, alignment and cutouts run in separate thread pools, so
+    while one field is being cut out, the next ones are already being
+    aligned and downloaded. At most max_fields fields are in flight,
+    which bounds the disk and memory used by intermediate files.
+    The state of each field is recorded in result/manifest.sqlite.
+    If CUTOUT_SCRATCH is set, the fields in flight are kept in a
+    scratch directory (see cutout.scratch).
     """
 
-    for idx, row in df.iterrows():
-        rerun, run, camcol, field = \
-            row[["rerun", "run", "camcol", "field"]].astype(int).values
+    run = metrics.start_run()
+
+    filename = os.path.abspath(filename)
+    save_dir = os.path.abspath("result")
+    temp_dir = os.path.join(scratch.scratch_dir() or os.getcwd(), "temp")
+
+    groups, counts = partition_catalog(
+        filename, save_dir=temp_dir, return_counts=True
+    )
+
+    manifest = open_manifest(
+        groups, counts, save_dir=save_dir, size=size,
+        image_dtype=image_dtype
+    )
+    todo = manifest.todo(max_attempts)
+    todo.sort(key=lambda group: counts[group], reverse=True)
+
+    print(
+        "Pipelined mode: Processing {} fields...\n".format(len(todo))
+    )
+
+    bands = [b for b in "ugriz"]
+    outputs = output_dirs(save_dir, size)
+
+    def fetch(group):
+        manifest_queue.put((group, time.time()))
+        chunk = read_partition(group, temp_dir)
+        field = tuple(
+            int(i) for i in chunk[["rerun", "run", "camcol", "field"]].values[0]
+        )
         print(
-            "{0}-{1}-{2}-{3}: Processing...".format(rerun, run, camcol, field)
+            "{}: Processing {} object(s)...".format(
+                "{0}-{1}-{2}-{3}".format(*field), len(chunk)
+            )
         )
-        try:
-            fetch_align_sex(rerun, run, camcol, field, remove=remove)
+        with metrics.field(group.replace("frame-", "")):
+            single_field_image(*field)
+        return group, chunk, field
+
+    def align(state):
+        group, chunk, field = state
+        with metrics.field(group.replace("frame-", "")):
+            registered_images = align_field(
+                *field, remove=remove, method=method
+            )
+        return group, chunk, field, registered_images
+
+    def cutout(state):
+        group, chunk, field, registered_images = state
+        with metrics.field(group.replace("frame-", "")):
+            try:
+                records = match_field(
+                    chunk, registered_images, field, bands=bands,
+                    size=[s for s, _ in outputs], method=method,
+                    image_dtype=image_dtype
+                )
+            finally:
+                if remove:
+                    remove_images(registered_images)
+            for (_, output_dir), records_ in zip(outputs, records):
+                if not os.path.exists(output_dir):
+                    os.makedirs(output_dir)
+                with metrics.timer("save"):
+                    np.save(
+                        os.path.join(output_dir, group + ".npy"), records_
+                    )
+                metrics.count("bytes_written", records_.nbytes)
+        return field
+
+    stages = [
+        (fetch, fetch_workers),
+        (align, align_workers),
+        (cutout, cutout_workers)
+    ]
+
+    # sqlite connections can only be used in the thread that made them,
+    # so the fetch threads queue the fields they start, with the time,
+    # and the queue is drained here while waiting for results.
+    manifest_queue = queue.Queue()
+
+    def update_manifest():
+        while not manifest_queue.empty():
+            group, started = manifest_queue.get()
+            manifest.start(group, started)
+
+    with scratch.working_dir():
+
+        for group, field, error in run_pipeline(
+            todo, stages, max_in_flight=max_fields, poll=update_manifest):
+
+            update_manifest()
+
+            name = group.replace("frame-", "")
+
+            if error is None:
+                manifest.done(group)
+                print("{}: Sucessfully completed.".format(name))
+            else:
+                manifest.fail(group, error)
+                print("{}: {}".format(name, error))
+
+    manifest.report()
+    metrics.report(run=run)
+
+    if remove and not manifest.todo(max_attempts=1):
+        clean_group_temp(temp_dir)
+
+    return None
+
+
+def pipeline_sex(df, remove=True, method="montage",
+    fetch_workers=4, align_workers=2, sex_workers=2, cutout_workers=2,
+    max_fields=8, detector="sex", size=64):
+    """
+    Pipelined mode.
+
+    Fetching, alignment, SExtractor and cutouts run in separate thread
+    pools connected by bounded queues. At most max_fields fields are
+    in flight. SExtractor keeps its configuration and catalogs in a
+    private directory, so several fields can be detected at once.
+    If CUTOUT_SCRATCH is set, the fields in flight are kept in a
+    scratch directory (see cutout.scratch).
+    """
+
+    run = metrics.start_run()
+
+    save_dir = os.path.abspath("result")
+
+    fields = [
+        tuple(int(i) for i in field)
+        for field in df[["rerun", "run", "camcol", "field"]].values
+    ]
+
+    print("Pipelined mode: Processing {} fields...\n".format(len(fields)))
+
+    def fetch(field):
+        with metrics.field("{0}-{1}-{2}-{3}".format(*field)):
+            single_field_image(*field)
+        return field
+
+    def align(field):
+        with metrics.field("{0}-{1}-{2}-{3}".format(*field)):
+            registered_images = align_field(
+                *field, remove=remove, method=method
+            )
+        return field, registered_images
+
+    def detect(state):
+        field, registered_images = state
+        reference_image = fits_file_name(*field, band='r')
+        with metrics.field("{0}-{1}-{2}-{3}".format(*field)):
+            catalog = run_detection(
+                reference_image, remove=remove, detector=detector
+            )
+        return field, registered_images, catalog
+
+    def cutout(state):
+        field, registered_images, catalog = state
+        reference_image = fits_file_name(*field, band='r')
+        with metrics.field("{0}-{1}-{2}-{3}".format(*field)):
+            sex_cutout(
+                catalog, registered_images, reference_image,
+                remove=remove, method=method, size=size, save_dir=save_dir
+            )
+        return field
+
+    stages = [
+        (fetch, fetch_workers),
+        (align, align_workers),
+        (detect, sex_workers),
+        (cutout, cutout_workers)
+    ]
+
+    with scratch.working_dir():
+
+        for field, _, error in run_pipeline(
+            fields, stages, max_in_flight=max_fields):
+
+            if error is None:
+                print(
+                    "{0}-{1}-{2}-{3}: Sucessfully completed.".format(*field)
+                )
+            else:
+                print("{0}-{1}-{2}-{3}: {4}".format(*(field + (error,))))
+
+    metrics.report(run=run)
+
+    return None
+
+
+def sequential_sex(df, remove=True, method="montage", detector="sex",
+    size=64):
+    """
+    Sequential mode.
+
+    If CUTOUT_SCRATCH is set, the intermediate files are kept in a
+    scratch directory (see cutout.scratch).
+    """
+
+    run = metrics.start_run()
+
+    save_dir = os.path.abspath("result")
+
+    with scratch.working_dir():
+
+        for idx, row in df.iterrows():
+            rerun, run, camcol, field = \
+                row[["rerun", "run", "camcol", "field"]].astype(int).values
             print(
-                "{0}-{1}-{2}-{3}: Sucessfully completed.".format(rerun, run, camcol, field)
+                "{0}-{1}-{2}-{3}: Processing...".format(
+                    rerun, run, camcol, field
+                )
             )
-        except Exception as e:
-            print(e)
+            try:
+                with metrics.field(
+                    "{0}-{1}-{2}-{3}".format(rerun, run, camcol, field)):
+                    fetch_align_sex(
+                        rerun, run, camcol, field, remove=remove,
+                        method=method, detector=detector, size=size,
+                        save_dir=save_dir
+                    )
+                print(
+                    "{0}-{1}-{2}-{3}: Sucessfully completed.".format(
+                        rerun, run, camcol, field
+                    )
+                )
+            except Exception as e:
+                print(e)
+
+    metrics.report(run=run)
 
     return None
 
 
-def parallel_sex(df, remove=True):
+def parallel_sex(df, remove=True, method="montage", detector="sex",
+    size=64):
     """
     Parallel mode.
+
+    Rank 0 hands out the fields, and the other ranks process one field
+    at a time as they become free. If CUTOUT_SCRATCH is set, each rank
+    keeps its intermediate files in its own scratch directory on its
+    node (see cutout.scratch).
     """
 
     from mpi4py import MPI
 
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
-    size = comm.Get_size()
+    n_cores = comm.Get_size()
 
-    start = len(df) // size * rank
-    end = len(df) // size * (rank + 1)
-    df = df[start:end]
+    # the ranks tag their events with the run id of rank 0.
+    run = comm.bcast(metrics.start_run() if rank == 0 else None, root=0)
+    metrics.start_run(run)
+
+    save_dir = os.path.abspath("result")
 
     if rank == 0:
-        print("Running on {} cores...\n".format(size))
+        print("Running on {} cores...\n".format(n_cores))
+        fields = [
+            tuple(int(i) for i in field)
+            for field in df[["rerun", "run", "camcol", "field"]].values
+        ]
+    else:
+        fields = None
+
+    def process(field):
+
+        rerun, run, camcol, field_ = field
 
-    for idx, row in df.iterrows():
-        rerun, run, camcol, field = \
-            row[["rerun", "run", "camcol", "field"]].astype(int).values
         print(
             "Core {0}, {1}-{2}-{3}-{4}: Processing...".format(
-                rank, rerun, run, camcol, field
+                rank, rerun, run, camcol, field_
             )
         )
+
         try:
-            fetch_align_sex(rerun, run, camcol, field, remove=remove)
-            print(
-                "Core {0}, {1}-{2}-{3}-{4}: Sucessfully completed.".format(
-                    rank, rerun, run, camcol, field
+            with metrics.field(
+                "{0}-{1}-{2}-{3}".format(rerun, run, camcol, field_)):
+                fetch_align_sex(
+                    rerun, run, camcol, field_, remove=remove, method=method,
+                    detector=detector, size=size, save_dir=save_dir
                 )
-            )
         except Exception as e:
-            print(
-                "Core {0}, {1}-{2}-{3}-{4}: {}".format(
-                    rank, rerun, run, camcol, field, e
-                )
+            raise Exception(
+                "{0}-{1}-{2}-{3}: {4}".format(rerun, run, camcol, field_, e)
+            )
+
+        print(
+            "Core {0}, {1}-{2}-{3}-{4}: Sucessfully completed.".format(
+                rank, rerun, run, camcol, field_
             )
+        )
+
+    with scratch.working_dir():
+        results = mpi_work_queue(comm, fields, process)
+
+    if rank == 0:
+        failed = [field for field, error in results if error is not None]
+        print(
+            "Parallel mode: {} fields completed, {} failed."
+            "".format(len(results) - len(failed), len(failed))
+        )
+        metrics.report(run=run)
 
     return None
@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from scipy import ndimage
+from cutout import metrics
+
+
+def detect_sources(image, thresh=1.5, minarea=3, back_size=64,
+    back_filtersize=3):
+    """
+    Detects sources in an image without SExtractor.
+
+    Follows the configuration written by cutout.sex: the background is
+    estimated on a mesh of back_size pixels, median-filtered over
+    back_filtersize meshes and interpolated. The background-subtracted
+    image is filtered with the same 3x3 kernel, thresholded at thresh
+    times the background RMS, and segmented into 8-connected regions
+    of at least minarea pixels. There is no deblending, so blended
+    sources are detected as one.
+
+    Parameters
+    ----------
+    image: A file name or a 2-d numpy array.
+
+    Returns
+    -------
+    A pandas dataframe with the columns XMIN_IMAGE, YMIN_IMAGE,
+    XMAX_IMAGE, YMAX_IMAGE, XPEAK_IMAGE and YPEAK_IMAGE (one-based pixel
+    positions, as in SExtractor), and FILE if image is a file name.
+    """
+
+    with metrics.timer("detect", detector="numpy"):
+        catalog = _detect_sources(
+            image, thresh, minarea, back_size, back_filtersize
+        )
+
+    return catalog
+
+
+def _detect_sources(image, thresh, minarea, back_size, back_filtersize):
+
+    if isinstance(image, str):
+        data = fits.getdata(image)
+    else:
+        data = image
+
+    data = np.asarray(data, dtype=np.float32)
+
+    background, rms = background_mesh(data, back_size, back_filtersize)
+
+    data = data - background
+
+    kernel = np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]], dtype=np.float32)
+    kernel /= kernel.sum()
+
+    filtered = ndimage.convolve(data, kernel, mode="nearest")
+
+    mask = filtered > thresh * rms
+
+    labels, n_labels = ndimage.label(mask, structure=np.ones((3, 3)))
+
+    index = np.arange(1, n_labels + 1)
+    area = ndimage.sum(mask, labels, index)
+    index = index[area >= minarea]
+
+    columns = [
+        "XMIN_IMAGE", "YMIN_IMAGE", "XMAX_IMAGE", "YMAX_IMAGE",
+        "XPEAK_IMAGE", "YPEAK_IMAGE"
+    ]
+
+    catalog = pd.DataFrame(
+        np.zeros((len(index), len(columns)), dtype=np.int64), columns=columns
+    )
+
+    if len(index) > 0:
+
+        slices = ndimage.find_objects(labels)
+        slices = [slices[i - 1] for i in index]
+
+        catalog["XMIN_IMAGE"] = [s[1].start + 1 for s in slices]
+        catalog["YMIN_IMAGE"] = [s[0].start + 1 for s in slices]
+        catalog["XMAX_IMAGE"] = [s[1].stop for s in slices]
+        catalog["YMAX_IMAGE"] = [s[0].stop for s in slices]
+
+        peaks = np.array(ndimage.maximum_position(data, labels, index))
+
+        catalog["XPEAK_IMAGE"] = peaks[:, 1] + 1
+        catalog["YPEAK_IMAGE"] = peaks[:, 0] + 1
+
+    if isinstance(image, str):
+        catalog["FILE"] = image
+
+    return catalog
+
+
+def background_mesh(data, back_size=64, back_filtersize=3, nsigma=3.0,
+    niter=5):
+    """
+    Estimates the background and its RMS on a mesh of back_size pixels.
+
+    In each mesh, the pixels are sigma-clipped, and the background is
+    the mode estimate 2.5 * median - 1.5 * mean (or the median in
+    crowded meshes, as in SExtractor). The mesh is median-filtered and
+    bilinearly interpolated back to the image.
+
+    Returns
+    -------
+    A tuple of (background image, RMS image).
+    """
+
+    ny, nx = data.shape
+    my = -(-ny // back_size)
+    mx = -(-nx // back_size)
+
+    padded = np.full((my * back_size, mx * back_size), np.nan, dtype=np.float32)
+    padded[:ny, :nx] = data
+
+    meshes = padded.reshape(my, back_size, mx, back_size)
+    meshes = meshes.transpose(0, 2, 1, 3).reshape(my, mx, -1)
+
+    with np.errstate(invalid="ignore"):
+        for _ in range(niter):
+            median = np.nanmedian(meshes, axis=-1)
+            std = np.nanstd(meshes, axis=-1)
+            clip = np.abs(meshes - median[..., None]) > nsigma * std[..., None]
+            meshes = np.where(clip, np.nan, meshes)
+
+    mean = np.nanmean(meshes, axis=-1)
+    median = np.nanmedian(meshes, axis=-1)
+    std = np.nanstd(meshes, axis=-1)
+
+    crowded = np.abs(mean - median) / np.where(std > 0, std, 1) > 0.3
+    mode = np.where(crowded, median, 2.5 * median - 1.5 * mean)
+
+    if back_filtersize > 1:
+        mode = ndimage.median_filter(mode, size=back_filtersize, mode="nearest")
+        std = ndimage.median_filter(std, size=back_filtersize, mode="nearest")
+
+    y = (np.arange(ny) - (back_size - 1) / 2.0) / back_size
+    x = (np.arange(nx) - (back_size - 1) / 2.0) / back_size
+    coords = np.meshgrid(
+        np.clip(y, 0, my - 1), np.clip(x, 0, mx - 1), indexing="ij"
+    )
+
+    background = ndimage.map_coordinates(mode, coords, order=1)
+    rms = ndimage.map_coordinates(std, coords, order=1)
+
+    return background.astype(np.float32), rms.astype(np.float32)
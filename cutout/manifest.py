@@ -0,0 +1,238 @@
+import json
+import os
+import sqlite3
+import time
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobManifest(object):
+    """
+    Records the state of every field of a run in an SQLite database,
+    so that a run can be resumed without checking every output file.
+
+    Each field is pending, running, done or failed, with the number of
+    attempts, the number of objects, the time taken and the last error.
+    Fields left running by a run that crashed are reset to pending when
+    the manifest is opened. The options that determine the outputs of
+    a run, such as the cutout sizes, are recorded with check_config.
+
+    Only one process should write to a manifest at a time
+    (the parent process, or rank 0 in MPI mode).
+    """
+
+    def __init__(self, path):
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS fields ("
+                "name TEXT PRIMARY KEY, "
+                "state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "objects INTEGER, "
+                "started REAL, "
+                "elapsed REAL, "
+                "error TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS config ("
+                "key TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "UPDATE fields SET state = ? WHERE state = ?",
+                (PENDING, RUNNING)
+            )
+
+    def check_config(self, config):
+        """
+        Records the options of a run (a dictionary of JSON values) the
+        first time they are seen, and raises a ValueError if an option
+        was recorded with a different value, since the fields that are
+        done would not have the outputs that this run expects.
+        """
+
+        recorded = dict(
+            (key, json.loads(value)) for key, value in
+            self.conn.execute("SELECT key, value FROM config")
+        )
+
+        for key, value in sorted(config.items()):
+            value = json.loads(json.dumps(value))
+            if key in recorded and recorded[key] != value:
+                raise ValueError(
+                    "{0} was made with {1}={2}, not {3}. Use another "
+                    "output directory, or remove the manifest to start "
+                    "over.".format(self.path, key, recorded[key], value)
+                )
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in config.items()]
+            )
+
+        return None
+
+    def add(self, names, counts=None, exists=None):
+        """
+        Adds fields as pending, unless they are already in the manifest.
+
+        Parameters
+        ----------
+        names: A list of strings.
+        counts: A dictionary with the number of objects in each field.
+        exists: A function that returns True if a new field already
+            has a result from a run without a manifest. Such fields
+            are marked as done.
+        """
+
+        if counts is None:
+            counts = {}
+
+        known = set(
+            row[0] for row in self.conn.execute("SELECT name FROM fields")
+        )
+        new = [name for name in names if name not in known]
+
+        rows = [
+            (
+                name,
+                DONE if exists is not None and exists(name) else PENDING,
+                counts.get(name)
+            )
+            for name in new
+        ]
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO fields (name, state, objects) VALUES (?, ?, ?)",
+                rows
+            )
+
+        return None
+
+    def todo(self, max_attempts=3):
+        """
+        Returns the fields that are pending, or that failed fewer than
+        max_attempts times.
+        """
+
+        rows = self.conn.execute(
+            "SELECT name FROM fields WHERE state = ? "
+            "OR (state = ? AND attempts < ?)",
+            (PENDING, FAILED, max_attempts)
+        )
+
+        return [row[0] for row in rows]
+
+    def start(self, name, started=None):
+        """
+        Marks a field as running, since started (a time.time() value,
+        by default now).
+        """
+
+        if started is None:
+            started = time.time()
+
+        with self.conn:
+            self.conn.execute(
+                "UPDATE fields SET state = ?, attempts = attempts + 1, "
+                "started = ? WHERE name = ?",
+                (RUNNING, started, name)
+            )
+
+    def done(self, name, elapsed=None):
+        """
+        Marks a field as done.
+        """
+
+        self._finish(name, DONE, None, elapsed)
+
+    def fail(self, name, error, elapsed=None):
+        """
+        Marks a field as failed, and records the error.
+        """
+
+        self._finish(name, FAILED, str(error), elapsed)
+
+    def summary(self):
+        """
+        Returns a dictionary with the number of fields in each state.
+        """
+
+        result = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+
+        rows = self.conn.execute(
+            "SELECT state, COUNT(*) FROM fields GROUP BY state"
+        )
+        result.update(dict(rows))
+
+        return result
+
+    def failures(self):
+        """
+        Returns a list of (name, attempts, error) of the failed fields.
+        """
+
+        rows = self.conn.execute(
+            "SELECT name, attempts, error FROM fields WHERE state = ? "
+            "ORDER BY name",
+            (FAILED,)
+        )
+
+        return list(rows)
+
+    def report(self, max_failures=20):
+        """
+        Prints the number of fields in each state and the last errors.
+        """
+
+        summary = self.summary()
+
+        print(
+            "Manifest: {} done, {} failed, {} pending, {} running.".format(
+                summary[DONE], summary[FAILED], summary[PENDING],
+                summary[RUNNING]
+            )
+        )
+
+        failures = self.failures()
+
+        for name, attempts, error in failures[:max_failures]:
+            print("  {} ({} attempts): {}".format(name, attempts, error))
+
+        if len(failures) > max_failures:
+            print("  ... and {} more.".format(len(failures) - max_failures))
+
+        return None
+
+    def close(self):
+        self.conn.close()
+
+    def _finish(self, name, state, error, elapsed):
+
+        if elapsed is None:
+            row = self.conn.execute(
+                "SELECT started FROM fields WHERE name = ?", (name,)
+            ).fetchone()
+            if row is not None and row[0] is not None:
+                elapsed = time.time() - row[0]
+
+        with self.conn:
+            self.conn.execute(
+                "UPDATE fields SET state = ?, error = ?, elapsed = ? "
+                "WHERE name = ?",
+                (state, error, elapsed, name)
+            )
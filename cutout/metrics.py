@@ -0,0 +1,293 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+
+_output = None
+_output_lock = threading.Lock()
+_local = threading.local()
+
+
+def metrics_dir():
+    """
+    Returns the directory set by the CUTOUT_METRICS_DIR environment
+    variable, or None if metrics are disabled.
+    """
+
+    return os.environ.get("CUTOUT_METRICS_DIR")
+
+
+def start_run(run=None):
+    """
+    Starts a run, and returns its id. The events emitted afterwards by
+    this process, and by the workers it starts, which inherit the id
+    through the CUTOUT_METRICS_RUN environment variable, are tagged
+    with it. The MPI drivers pass the id of rank 0 to the other ranks.
+    """
+
+    if run is None:
+        run = "{}-{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S"), socket.gethostname(), os.getpid()
+        )
+
+    os.environ["CUTOUT_METRICS_RUN"] = run
+
+    return run
+
+
+def run_id():
+    """
+    Returns the id of the current run, or None outside a run.
+    """
+
+    return os.environ.get("CUTOUT_METRICS_RUN")
+
+
+def process_rank():
+    """
+    Returns the MPI rank of this process from the environment of the
+    common MPI launchers, or None outside MPI.
+    """
+
+    for name in ["OMPI_COMM_WORLD_RANK", "PMI_RANK", "PMIX_RANK", "SLURM_PROCID"]:
+        if name in os.environ:
+            return int(os.environ[name])
+
+    return None
+
+
+def _open_output():
+
+    global _output
+
+    directory = metrics_dir()
+
+    if directory is None:
+        return None
+
+    with _output_lock:
+
+        # a forked worker must not write to its parent's file.
+        if _output is not None and _output[0] == os.getpid():
+            return _output[1]
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        rank = process_rank()
+        path = os.path.join(
+            directory, "metrics-{}-{}-{}.jsonl".format(
+                "rank{}".format(rank) if rank is not None else "local",
+                socket.gethostname(), os.getpid()
+            )
+        )
+        _output = (os.getpid(), open(path, "a", buffering=1))
+
+    return _output[1]
+
+
+def emit(event):
+    """
+    Writes an event (a dictionary) as a JSON line to this process's
+    metrics file in CUTOUT_METRICS_DIR. Does nothing if metrics are
+    disabled.
+    """
+
+    output = _open_output()
+
+    if output is None:
+        return None
+
+    event["time"] = time.time()
+    event["rank"] = process_rank()
+    event["pid"] = os.getpid()
+    event["run"] = run_id()
+
+    current = getattr(_local, "field", None)
+    if current is not None and "field" not in event:
+        event["field"] = current
+
+    line = json.dumps(event)
+
+    with _output_lock:
+        output.write(line + "\n")
+
+    return None
+
+
+@contextmanager
+def timer(stage, **fields):
+    """
+    Times the enclosed block, and emits a timer event for stage with the
+    elapsed seconds. The event is emitted even if the block raises.
+    """
+
+    if metrics_dir() is None:
+        yield
+        return
+
+    start = time.time()
+
+    try:
+        yield
+    finally:
+        event = {"type": "timer", "stage": stage}
+        event.update(fields)
+        event["seconds"] = time.time() - start
+        emit(event)
+
+
+def count(name, value=1, **fields):
+    """
+    Emits a counter event, e.g. the number of bytes downloaded.
+    """
+
+    if metrics_dir() is None:
+        return None
+
+    event = {"type": "count", "name": name, "value": value}
+    event.update(fields)
+    emit(event)
+
+    return None
+
+
+@contextmanager
+def field(name):
+    """
+    Tags the events emitted by this thread in the enclosed block with
+    the field name, and times the whole block as the "field" stage.
+    """
+
+    previous = getattr(_local, "field", None)
+    _local.field = name
+
+    try:
+        with timer("field"):
+            yield
+    finally:
+        _local.field = previous
+
+
+def read_events(directory):
+    """
+    Reads the events of all processes in a metrics directory.
+
+    Returns
+    -------
+    A list of dictionaries.
+    """
+
+    events = []
+
+    for path in sorted(glob.glob(os.path.join(directory, "metrics-*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # a process that was killed may leave a partial line.
+                    continue
+
+    return events
+
+
+def summarize(events):
+    """
+    Aggregates events.
+
+    Returns
+    -------
+    A tuple of (stages, counters, fields). stages maps each stage to a
+    dictionary with its count, total, mean and max seconds; counters
+    maps each counter to its total; fields maps each field to the
+    seconds spent on it.
+    """
+
+    stages = {}
+    counters = {}
+    fields = {}
+
+    for event in events:
+
+        if event.get("type") == "timer":
+
+            stage = event["stage"]
+            seconds = event["seconds"]
+
+            if stage == "field":
+                fields[event.get("field")] = (
+                    fields.get(event.get("field"), 0.0) + seconds
+                )
+                continue
+
+            if stage not in stages:
+                stages[stage] = {"count": 0, "total": 0.0, "max": 0.0}
+            stages[stage]["count"] += 1
+            stages[stage]["total"] += seconds
+            stages[stage]["max"] = max(stages[stage]["max"], seconds)
+
+        elif event.get("type") == "count":
+            name = event["name"]
+            counters[name] = counters.get(name, 0) + event["value"]
+
+    for stage in stages.values():
+        stage["mean"] = stage["total"] / stage["count"]
+
+    return stages, counters, fields
+
+
+def report(directory=None, slowest=10, run=None):
+    """
+    Prints the time spent in each stage over all processes, the
+    counters, and the slowest fields. If run is given, only the events
+    of that run are included; otherwise, those of every run in the
+    directory.
+    """
+
+    if directory is None:
+        directory = metrics_dir()
+
+    if directory is None or not os.path.exists(directory):
+        return None
+
+    events = read_events(directory)
+
+    if run is not None:
+        events = [event for event in events if event.get("run") == run]
+
+    stages, counters, fields = summarize(events)
+
+    grand_total = sum(stage["total"] for stage in stages.values())
+
+    print("\n{0:<12} {1:>8} {2:>12} {3:>7} {4:>10} {5:>10}".format(
+        "stage", "count", "seconds", "share", "mean", "max"
+    ))
+
+    for name, stage in sorted(
+        stages.items(), key=lambda item: item[1]["total"], reverse=True):
+        print("{0:<12} {1:>8} {2:>12.1f} {3:>6.1f}% {4:>10.3f} {5:>10.3f}".format(
+            name, stage["count"], stage["total"],
+            100.0 * stage["total"] / max(grand_total, 1e-9),
+            stage["mean"], stage["max"]
+        ))
+
+    if counters:
+        print("")
+        for name in sorted(counters):
+            print("{0:<24} {1:>16}".format(name, counters[name]))
+
+    if fields:
+        print("\nSlowest fields:")
+        for name, seconds in sorted(
+            fields.items(), key=lambda item: item[1], reverse=True)[:slowest]:
+            print("  {0}: {1:.1f} s".format(name, seconds))
+
+    return None
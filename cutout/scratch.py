@@ -0,0 +1,170 @@
+import atexit
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+# environment variables that hold paths, which are made absolute before
+# changing into the scratch directory.
+PATH_VARIABLES = [
+    "CUTOUT_CACHE_DIR", "CUTOUT_FRAMES_DIR", "CUTOUT_METRICS_DIR"
+]
+
+_scratch = None
+_scratch_lock = threading.Lock()
+
+
+def scratch_root():
+    """
+    Returns the directory set by the CUTOUT_SCRATCH environment variable,
+    e.g. /dev/shm or a node-local $TMPDIR, or None if intermediate files
+    are written to the working directory.
+    """
+
+    root = os.environ.get("CUTOUT_SCRATCH")
+
+    if not root:
+        return None
+
+    return os.path.abspath(root)
+
+
+def scratch_dir():
+    """
+    Returns the private scratch directory of this process under
+    scratch_root(), and creates it on first use. The directory and
+    everything in it are removed when the process exits, including on
+    SIGTERM (e.g. from a batch scheduler), and the directories of
+    processes on this host that were killed before they could clean
+    up are removed when a new one is created. A worker
+    process started by a process that has a scratch directory gets a
+    subdirectory of it, which is removed with its parent's, since
+    workers do not run exit handlers.
+
+    Returns
+    -------
+    A string, or None if CUTOUT_SCRATCH is not set.
+    """
+
+    global _scratch
+
+    root = scratch_root()
+
+    if root is None:
+        return None
+
+    with _scratch_lock:
+
+        if _scratch is not None and _scratch[0] == os.getpid():
+            return _scratch[1]
+
+        # set by the parent process, and inherited by its workers.
+        parent = os.environ.get("CUTOUT_SCRATCH_PARENT")
+
+        if parent is not None and os.path.isdir(parent):
+            path = os.path.join(parent, "worker-{}".format(os.getpid()))
+            os.makedirs(path, exist_ok=True)
+        else:
+            os.makedirs(root, exist_ok=True)
+            remove_stale(root)
+            path = tempfile.mkdtemp(
+                prefix="cutout-{}-{}-".format(
+                    socket.gethostname(), os.getpid()
+                ),
+                dir=root
+            )
+            atexit.register(shutil.rmtree, path, True)
+            _exit_on_sigterm()
+            os.environ["CUTOUT_SCRATCH_PARENT"] = path
+            # the drivers and workers change into the scratch directory.
+            for name in PATH_VARIABLES:
+                if os.environ.get(name):
+                    os.environ[name] = os.path.abspath(os.environ[name])
+
+        _scratch = (os.getpid(), path)
+
+    return path
+
+
+def remove_stale(root):
+    """
+    Removes the scratch directories in root that were made on this host
+    by processes that are no longer running.
+    """
+
+    prefix = "cutout-{}-".format(socket.gethostname())
+
+    for name in os.listdir(root):
+
+        if not name.startswith(prefix):
+            continue
+
+        pid = name[len(prefix):].split("-")[0]
+
+        if pid.isdigit() and not _is_running(int(pid)):
+            shutil.rmtree(os.path.join(root, name), True)
+
+
+def _is_running(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # a process of another user.
+        return True
+
+    return True
+
+
+def _exit_on_sigterm():
+
+    # signal handlers can only be set in the main thread, and a handler
+    # set by the caller is left alone.
+    if threading.current_thread() is not threading.main_thread():
+        return None
+
+    if signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL:
+        return None
+
+    def handler(signum, frame):
+        # runs the exit handlers, unlike the default action.
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handler)
+
+    return None
+
+
+@contextmanager
+def working_dir():
+    """
+    Changes into scratch_dir() for the enclosed block, so the frames,
+    registered images, SExtractor files and other intermediate files,
+    which are written relative to the working directory, go to scratch.
+    Does nothing if CUTOUT_SCRATCH is not set.
+
+    Paths that the drivers write their results to must be made absolute
+    before entering the block. The paths in PATH_VARIABLES are made
+    absolute by scratch_dir.
+    """
+
+    path = scratch_dir()
+
+    if path is None:
+        yield os.getcwd()
+        return
+
+    cwd = os.getcwd()
+    os.chdir(path)
+
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
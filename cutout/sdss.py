@@ -1,11 +1,19 @@
 import os
 import requests
 import bz2
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from time import sleep
 import numpy as np
 import pandas as pd
 from astropy.io import fits
 from astropy import wcs
+from cutout import metrics
+
+
+SDSS_FRAMES_URL = "http://data.sdss3.org/sas/dr12/boss/photoObj/frames/"
 
 
 def fits_file_name(rerun, run, camcol, field, band):
@@ -25,12 +33,16 @@ def fits_file_name(rerun, run, camcol, field, band):
 def field_image_url(rerun, run, camcol, field, band, base_url=None):
     """
     Returns URL for compressed FITS file for a single field SDSS DR12 image.
+
+    The frames are looked up under the CUTOUT_SDSS_URL environment
+    variable if it is set (e.g. a local mirror), and under
+    http://data.sdss3.org/sas/dr12/boss/photoObj/frames/ otherwise.
     """
 
     if base_url is None:
-        base_url = requests.compat.urljoin(
-            "http://data.sdss3.org/sas/dr12/boss/photoObj/frames/",
-            "{0}/{1}/{2}/".format(rerun, run, camcol)
+        base_url = (
+            os.environ.get("CUTOUT_SDSS_URL", SDSS_FRAMES_URL).rstrip("/")
+            + "/{0}/{1}/{2}/".format(rerun, run, camcol)
         )
 
     file_name = fits_file_name(rerun, run, camcol, field, band) + ".bz2"
@@ -40,56 +52,360 @@ def field_image_url(rerun, run, camcol, field, band, base_url=None):
     return url
 
 
-def single_field_image(rerun, run, camcol, field,
-    base_url=None, bands='ugriz', ntry=10, save_dir=None):
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {}
+
+
+def http_session(pool_size=16):
     """
-    Download a single field SDSS DR12 image.
+    Returns a requests.Session shared by all downloads in this process,
+    so that connections to the SDSS server are kept alive and reused.
     """
 
-    files = [
-        fits_file_name(rerun, run, camcol, field, band)
-        for band in bands
-    ]
+    global _session
 
-    if all(os.path.exists(f) for f in files):
-        return
+    with _session_lock:
+        if _session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size
+            )
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+
+    return _session
+
+
+def host_slots(url, max_per_host=4):
+    """
+    Returns a semaphore that limits the number of concurrent requests
+    to the host of the URL.
+    """
+
+    host = requests.compat.urlparse(url).netloc
+
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(max_per_host)
+
+    return _host_slots[host]
+
+
+def download_file(url, file_path, ntry=10, backoff=1.0, max_backoff=60.0,
+    max_per_host=4, timeout=60, chunk_size=1 << 20):
+    """
+    Downloads a bz2-compressed FITS file and saves it uncompressed.
+    Failed requests are retried with exponential backoff, except for
+    client errors (HTTP 4xx other than 408 and 429), such as a missing
+    frame, which will not go away by retrying.
+
+    The compressed stream is written to '<file_path>.bz2.part', and an
+    interrupted download resumes from the end of the partial file.
+    The file is then decompressed incrementally, verified, and renamed
+    to file_path, so file_path is either absent or a complete FITS file.
+
+    Returns
+    -------
+    True if the file was saved, False otherwise.
+    """
+
+    session = http_session()
+    file_name = os.path.basename(file_path)
+    part_path = file_path + ".bz2.part"
+
+    def wait(attempt):
+        # there is nothing to wait for after the last attempt.
+        if attempt + 1 < ntry:
+            sleep(min(backoff * 2 ** attempt, max_backoff))
+
+    for attempt in range(ntry):
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+
+        try:
+            with host_slots(url, max_per_host), metrics.timer(
+                "download", file=file_name):
+                resp = session.get(
+                    url, headers=headers, stream=True, timeout=timeout
+                )
+                with resp:
+                    complete = _write_response(resp, part_path, chunk_size)
+        except requests.RequestException as e:
+            print(e)
+            wait(attempt)
+            continue
+
+        if complete is None:
+            print("{}: HTTP {}".format(file_name, resp.status_code))
+            if 400 <= resp.status_code < 500 and \
+                resp.status_code not in (408, 429):
+                return False
+            wait(attempt)
+            continue
+
+        if not complete:
+            print("{}: Incomplete download, resuming.".format(file_name))
+            wait(attempt)
+            continue
+
+        try:
+            with metrics.timer("decompress", file=file_name):
+                decompress_file(part_path, file_path, chunk_size=chunk_size)
+            metrics.count("bytes_decompressed", os.path.getsize(file_path))
+        except (OSError, EOFError) as e:
+            print("{}: {}".format(file_name, e))
+            os.remove(part_path)
+            wait(attempt)
+            continue
+
+        os.remove(part_path)
+
+        return True
+
+    return False
+
+
+def _write_response(resp, part_path, chunk_size):
+    """
+    Appends a (possibly partial) HTTP response body to part_path.
+
+    Returns
+    -------
+    None if the request failed, True if the whole file has been received,
+    and False if the transfer ended early.
+    """
+
+    if resp.status_code == 416:
+        # the partial file already holds the whole body.
+        return True
+
+    if resp.status_code == 206:
+        mode = "ab"
+    elif resp.status_code == 200:
+        mode = "wb"
+    else:
+        return None
+
+    expected = resp.headers.get("Content-Length")
+    received = 0
+
+    with open(part_path, mode) as f:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+            received += len(chunk)
+
+    metrics.count("bytes_downloaded", received)
+
+    if expected is not None and received != int(expected):
+        return False
+
+    return True
+
+
+def decompress_file(bz2_path, file_path, chunk_size=1 << 20):
+    """
+    Decompresses bz2_path into file_path without holding either file
+    in memory. The output is written to a temporary file, checked with
+    valid_fits, and atomically renamed to file_path.
+    """
+
+    temp_path = file_path + ".tmp"
+    decompressor = bz2.BZ2Decompressor()
+
+    try:
+        with open(bz2_path, "rb") as fin, open(temp_path, "wb") as fout:
+            for chunk in iter(lambda: fin.read(chunk_size), b""):
+                fout.write(decompressor.decompress(chunk))
+
+        if not decompressor.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker")
+
+        if not valid_fits(temp_path):
+            raise OSError("Corrupt FITS file")
+
+        os.replace(temp_path, file_path)
+
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return None
+
+
+def valid_fits(file_path):
+    """
+    Checks that a FITS file exists and is as long as its headers say,
+    so that truncated or half-written files are not mistaken for
+    complete ones.
+    """
+
+    if not os.path.exists(file_path):
+        return False
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            with fits.open(file_path, memmap=True) as hdulist:
+                info = hdulist[-1].fileinfo()
+                expected = info["datLoc"] + info["datSpan"]
+    except Exception:
+        return False
+
+    return os.path.getsize(file_path) == expected
+
+
+def fetch_fields(fields, base_url=None, bands='ugriz', ntry=10,
+    save_dir=None, max_workers=8, max_per_host=4):
+    """
+    Downloads the images of many fields concurrently.
+
+    This is a generator that yields (field, error) as soon as all bands
+    of a field are on disk, where field is a (rerun, run, camcol, field)
+    tuple and error is None on success.
+
+    Parameters
+    ----------
+    fields: An iterable of (rerun, run, camcol, field) tuples.
+    max_workers: Number of download threads.
+    max_per_host: Maximum number of concurrent requests per host.
+    """
 
     if save_dir is None:
         save_dir = os.getcwd()
 
     bands = [b for b in bands]
 
-    for band in bands:
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    remaining = {}
+
+    try:
+
+        for field in fields:
+
+            field = tuple(int(i) for i in field)
+
+            files = [
+                os.path.join(save_dir, fits_file_name(*field, band=band))
+                for band in bands
+            ]
+
+            missing = [
+                (band, f) for band, f in zip(bands, files)
+                if not valid_fits(f)
+            ]
+
+            if not missing:
+                yield field, None
+                continue
+
+            remaining[field] = len(missing)
+
+            for band, file_path in missing:
+                url = field_image_url(*field, band=band, base_url=base_url)
+                future = executor.submit(
+                    download_file, url, file_path,
+                    ntry=ntry, max_per_host=max_per_host
+                )
+                futures[future] = (field, file_path)
 
-        url = field_image_url(rerun, run, camcol, field, band, base_url)
-        file_name = fits_file_name(rerun, run, camcol, field, band)
-        file_path = os.path.join(save_dir, file_name)
+        failed = set()
 
-        for _ in range(ntry):
+        for future in as_completed(futures):
+
+            field, file_path = futures[future]
 
             try:
-                resp = requests.get(url)
+                if not future.result():
+                    failed.add(field)
             except Exception as e:
-                print(e)
-                sleep(1)
-                continue
-                
-            if resp.status_code == 200:
+                print("{}: {}".format(os.path.basename(file_path), e))
+                failed.add(field)
+
+            remaining[field] -= 1
+
+            if remaining[field] == 0:
+                if field in failed:
+                    error = Exception(
+                        "{0}-{1}-{2}-{3}: Download failed.".format(*field)
+                    )
+                else:
+                    error = None
+                yield field, error
+
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
 
-                with open(file_path, "wb") as f:
-                    image = bz2.decompress(resp.content)
-                    f.write(image)
 
-                break
+def prefetch_fields(fields, save_dir=None, max_workers=8):
+    """
+    Fetches the images of many fields into save_dir like fetch_fields,
+    but from the configured frame source (see single_field_image), so
+    that prefetching fills the frame cache configured with
+    CUTOUT_CACHE_DIR, or reads the local frame tree configured with
+    CUTOUT_FRAMES_DIR.
+
+    This is a generator that yields (field, error) as each field is done.
+    """
+
+    from cutout.source import default_source, HTTPSource
 
-            else:
-                print("{}: HTTP {}".format(file_name, resp.status_code))
-                sleep(1)
+    source = default_source()
 
-    if all(os.path.exists(f) for f in files):
+    if isinstance(source, HTTPSource) and not source.cache:
+        for result in fetch_fields(
+            fields, save_dir=save_dir, max_workers=max_workers):
+            yield result
         return
-    else:
-        raise Exception
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        futures = {}
+
+        for field in fields:
+            field = tuple(int(i) for i in field)
+            future = executor.submit(source.fetch, *field, save_dir=save_dir)
+            futures[future] = field
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+                yield futures[future], None
+            except Exception as e:
+                yield futures[future], e
+
+
+def single_field_image(rerun, run, camcol, field,
+    base_url=None, bands='ugriz', ntry=10, save_dir=None, cache=None,
+    source=None):
+    """
+    Download a single field SDSS DR12 image.
+    The bands are downloaded concurrently.
+
+    The frames are taken from a frame source (see cutout.source): the
+    local frame tree configured with CUTOUT_FRAMES_DIR if there is one,
+    or an HTTPSource otherwise. base_url overrides the URL of the
+    directory of the field.
+
+    If a frame cache is given (or configured with CUTOUT_CACHE_DIR),
+    downloaded frames are read through the cache and linked into
+    save_dir. Pass cache=False to bypass the cache.
+    """
+
+    if source is None:
+        from cutout.source import default_source
+        source = default_source(cache)
+
+    source.fetch(
+        rerun, run, camcol, field,
+        bands=bands, save_dir=save_dir, ntry=ntry, base_url=base_url
+    )
+
+    return None
 
 
 def sdss_fields(filename, shuffle=True):
@@ -114,15 +430,17 @@ def sdss_fields(filename, shuffle=True):
     return df
 
 
-def fetch_sdss(filename):
+def fetch_sdss(filename, max_workers=8):
     """
     Reads a CSV file and fetches all field images listed in the file.
     """
 
     df = sdss_fields(filename)
+    groups = df.groupby(["rerun", "run", "camcol", "field"]).groups
 
-    for group in df.groupby(["rerun", "run", "camcol", "field"]).groups:
-        single_field_image(*group)
+    for field, error in prefetch_fields(groups, max_workers=max_workers):
+        if error is not None:
+            print(error)
 
     return None
 
@@ -140,8 +458,8 @@ def read_match_csv(filename, shuffle=True, skiprows=None, chunksize=None):
 
     dtype = {
         "objID": np.uint64,
-        "ra": np.float,
-        "dec": np.float,
+        "ra": np.float64,
+        "dec": np.float64,
         "rerun": np.uint16,
         "run": np.uint16,
         "camcol": np.uint16,
@@ -162,6 +480,19 @@ def read_match_csv(filename, shuffle=True, skiprows=None, chunksize=None):
     return df
 
 
+@lru_cache(maxsize=256)
+def field_wcs(rerun, run, camcol, field, band='r'):
+    """
+    Returns the WCS of a single field image.
+    The WCS objects are cached, so the header is only parsed once per field.
+    """
+
+    fits_file = fits_file_name(rerun, run, camcol, field, band)
+    header = fits.getheader(fits_file)
+
+    return wcs.WCS(header, relax=False)
+
+
 def single_radec_to_pixel(rerun, run, camcol, field, ra, dec):
     """
     Converts world position (RA, DEC) to pixel position.
@@ -171,9 +502,7 @@ def single_radec_to_pixel(rerun, run, camcol, field, ra, dec):
     A tuple of (float, float)
     """
 
-    fits_file = fits_file_name(rerun, run, camcol, field, 'r')
-    hdulist = fits.open(fits_file)
-    w = wcs.WCS(hdulist[0].header, relax=False)
+    w = field_wcs(rerun, run, camcol, field)
     px, py = w.all_world2pix(ra, dec, 1)
 
     return px.item(), py.item()
@@ -183,6 +512,9 @@ def df_radec_to_pixel(df):
     """
     Takes a pandas dataframe with ra, dec columns and converts radec to pixel positions.
 
+    The WCS is built once per field, and all positions in the field
+    are converted in a single call.
+
     Paramters
     ---------
     df: A pandas dataframe
@@ -190,16 +522,25 @@ def df_radec_to_pixel(df):
 
     result = df.copy()
 
-    for idx, row in df.iterrows():
+    xpeak = np.zeros(len(df))
+    ypeak = np.zeros(len(df))
+
+    groups = df.groupby(["rerun", "run", "camcol", "field"]).indices
+
+    for field, rows in groups.items():
+
+        rerun, run, camcol, field_ = (int(i) for i in field)
+
+        with metrics.timer("wcs"):
+            w = field_wcs(rerun, run, camcol, field_)
 
-        rerun, run, camcol, field = \
-            row[["rerun", "run", "camcol", "field"]].astype(int).values
-        ra, dec = row[["ra", "dec"]].values
+            ra = df["ra"].values[rows]
+            dec = df["dec"].values[rows]
 
-        px, py = single_radec_to_pixel(rerun, run, camcol, field, ra, dec)
+            xpeak[rows], ypeak[rows] = w.all_world2pix(ra, dec, 1)
 
-        result.loc[idx, "XPEAK_IMAGE"] = px
-        result.loc[idx, "YPEAK_IMAGE"] = py
+    result["XPEAK_IMAGE"] = xpeak
+    result["YPEAK_IMAGE"] = ypeak
 
     return result
 
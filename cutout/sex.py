@@ -1,53 +1,108 @@
+import atexit
 import os
-import pandas as pd
-import re
 import shutil
 import subprocess
+import tempfile
+import threading
+from astropy.table import Table
+from cutout import metrics, scratch
 
 
-def run_sex(filename, remove=True):
+_config_dirs = set()
+_config_lock = threading.Lock()
+
+
+def run_sex(filename, remove=True, workdir=None, checkimage=False):
     """
     Runs SExtractor.
+
+    The configuration files are written once per process into a private
+    directory (see sex_config_dir), and the per-field settings are passed
+    on the command line, so several fields can be processed at once in
+    the same working directory. The catalog is written as a binary
+    FITS_LDAC table. The segmentation check image is only written, as
+    '<filename>.check.fits', if checkimage is True.
     """
 
-    write_default_conv()
-    write_default_param()
-    write_default_sex()
-
-    config_file = filename.replace(".fits", ".sex")
-    catalog_name = filename.replace(".fits", ".cat")
-
-    with open("default.sex", "r") as default_sex:
-        with open(config_file, "w") as outfile:
-            for line in default_sex:
-                 line = re.sub(
-                     r"^CATALOG_NAME\s+temp.cat",
-                     "CATALOG_NAME     {}".format(catalog_name),
-                     line
-                 )
-                 outfile.write(line)
-    
-    subprocess.call(["sex", "-c", config_file, filename])
-
-    with open(catalog_name) as f:
-        column_names = [line.split()[2] for line in f if line.startswith('#')]
-
-    catalog = pd.read_csv(
-        catalog_name,
-        comment="#",
-        sep="\s+",
-        names=column_names
+    config_dir = sex_config_dir(workdir)
+
+    name = os.path.basename(filename).replace(".fits", "")
+    catalog_name = os.path.join(
+        config_dir, "{}-{}.cat".format(name, threading.get_ident())
     )
 
+    command = [
+        "sex", filename,
+        "-c", os.path.join(config_dir, "default.sex"),
+        "-PARAMETERS_NAME", os.path.join(config_dir, "default.param"),
+        "-FILTER_NAME", os.path.join(config_dir, "default.conv"),
+        "-CATALOG_NAME", catalog_name,
+        "-CATALOG_TYPE", "FITS_LDAC"
+    ]
+
+    if checkimage:
+        command += [
+            "-CHECKIMAGE_TYPE", "SEGMENTATION",
+            "-CHECKIMAGE_NAME", filename.replace(".fits", ".check.fits")
+        ]
+    else:
+        command += ["-CHECKIMAGE_TYPE", "NONE"]
+
+    with metrics.timer("detect", detector="sex"):
+        returncode = subprocess.call(command)
+
+    if returncode != 0 or not os.path.exists(catalog_name):
+        raise Exception(
+            "{}: SExtractor failed with exit code {}.".format(
+                filename, returncode
+            )
+        )
+
+    table = Table.read(catalog_name, hdu="LDAC_OBJECTS", memmap=True)
+    catalog = table.to_pandas()
+
     catalog["FILE"] = filename
 
+    del table
+
     if remove:
-        os.remove(config_file)
         os.remove(catalog_name)
 
     return catalog
 
 
+def sex_config_dir(workdir=None):
+    """
+    Writes the SExtractor configuration files into workdir, once per
+    process, and returns workdir. By default, workdir is a private
+    directory in the scratch directory (see cutout.scratch), or in the
+    temporary directory, that is removed when the process exits.
+    """
+
+    with _config_lock:
+
+        if workdir is None:
+            workdir = os.path.join(
+                scratch.scratch_dir() or tempfile.gettempdir(),
+                "cutout-sex-{}".format(os.getpid())
+            )
+            if workdir not in _config_dirs:
+                atexit.register(shutil.rmtree, workdir, True)
+
+        if workdir not in _config_dirs:
+
+            if not os.path.exists(workdir):
+                os.makedirs(workdir)
+
+            write_default_conv(os.path.join(workdir, "default.conv"))
+            write_default_param(os.path.join(workdir, "default.param"))
+            write_default_sex(os.path.join(workdir, "default.sex"))
+
+            _config_dirs.add(workdir)
+
+    return workdir
+
+
 def write_default_conv(filename="default.conv"):
 
     default_conv = (
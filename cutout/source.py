@@ -0,0 +1,187 @@
+import os
+from cutout import metrics
+from cutout.sdss import (
+    decompress_file, fetch_fields, fits_file_name, valid_fits
+)
+
+
+def default_source(cache=None):
+    """
+    Returns the local frame tree configured by the CUTOUT_FRAMES_DIR
+    environment variable if it is set, and an HTTPSource otherwise,
+    which downloads through the frame cache (see cutout.cache).
+
+    Parameters
+    ----------
+    cache: A FrameCache, None for the cache configured by
+        CUTOUT_CACHE_DIR (if any), or False for no cache.
+    """
+
+    root = os.environ.get("CUTOUT_FRAMES_DIR")
+
+    if root is not None:
+        return LocalSource(root)
+
+    if cache is None:
+        from cutout.cache import default_cache
+        cache = default_cache()
+
+    return HTTPSource(cache=cache or None)
+
+
+class HTTPSource(object):
+    """
+    Downloads frames from the SDSS server, or from a mirror of the
+    photoObj/frames tree at root (see field_image_url). If a frame cache
+    is given, the frames are downloaded into the cache, and linked into
+    the working directory.
+    """
+
+    def __init__(self, root=None, cache=None):
+        self.root = root
+        self.cache = cache
+
+    def field_url(self, rerun, run, camcol):
+        """
+        Returns the URL of the directory of a camera column, or None for
+        the default (see field_image_url).
+        """
+
+        if self.root is None:
+            return None
+
+        return self.root.rstrip("/") + "/{0}/{1}/{2}/".format(
+            rerun, run, camcol
+        )
+
+    def fetch(self, rerun, run, camcol, field,
+        bands='ugriz', save_dir=None, ntry=10, base_url=None):
+        """
+        Makes the bands of a field available in save_dir, downloading
+        the bands that are not already there (or in the cache).
+        base_url overrides the URL of the directory of the field.
+
+        Returns
+        -------
+        A list of strings.
+        """
+
+        from cutout.cache import link_frame
+
+        if save_dir is None:
+            save_dir = os.getcwd()
+
+        if base_url is None:
+            base_url = self.field_url(rerun, run, camcol)
+
+        destinations = [
+            os.path.join(
+                save_dir, fits_file_name(rerun, run, camcol, field, band)
+            )
+            for band in bands
+        ]
+
+        if self.cache:
+            paths = self.cache.fetch(
+                rerun, run, camcol, field,
+                bands=bands, base_url=base_url, ntry=ntry
+            )
+            for path, destination in zip(paths, destinations):
+                link_frame(path, destination)
+            return destinations
+
+        fields = [(rerun, run, camcol, field)]
+
+        for _, error in fetch_fields(
+            fields, base_url=base_url, bands=bands, ntry=ntry,
+            save_dir=save_dir):
+            if error is not None:
+                raise error
+
+        return destinations
+
+
+class LocalSource(object):
+    """
+    Reads frames from a copy of the SDSS photoObj/frames tree on a local
+    or shared filesystem, laid out as
+    <root>/<rerun>/<run>/<camcol>/frame-<band>-<run>-<camcol>-<field>.fits
+    (or .fits.bz2).
+
+    Uncompressed frames are linked into the working directory rather
+    than copied, so they are read in place; astropy memory-maps them,
+    and only the pages that are used are read. Compressed frames have
+    to be decompressed into the working directory.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, rerun, run, camcol, field, band):
+        """
+        Returns the path of an uncompressed frame in the tree.
+        """
+
+        return os.path.join(
+            self.root, str(rerun), str(run), str(camcol),
+            fits_file_name(rerun, run, camcol, field, band)
+        )
+
+    def fetch(self, rerun, run, camcol, field,
+        bands='ugriz', save_dir=None, ntry=None, base_url=None):
+        """
+        Makes the bands of a field available in save_dir. ntry and
+        base_url are only used by HTTPSource.
+
+        save_dir must not be the directory of the field in the tree,
+        since the working copies are removed after use.
+
+        Returns
+        -------
+        A list of strings.
+        """
+
+        from cutout.cache import link_frame
+
+        if save_dir is None:
+            save_dir = os.getcwd()
+
+        field_dir = os.path.dirname(self.path(rerun, run, camcol, field, 'r'))
+
+        if os.path.isdir(field_dir) and os.path.samefile(save_dir, field_dir):
+            raise ValueError(
+                "{0}: Frames cannot be fetched into the frame tree.".format(
+                    save_dir
+                )
+            )
+
+        paths = []
+
+        for band in bands:
+
+            source = self.path(rerun, run, camcol, field, band)
+            destination = os.path.join(
+                save_dir, fits_file_name(rerun, run, camcol, field, band)
+            )
+
+            if os.path.exists(source):
+                link_frame(source, destination)
+                metrics.count("local_frames", 1)
+
+            elif os.path.exists(source + ".bz2"):
+                if not valid_fits(destination):
+                    with metrics.timer("decompress", file=destination):
+                        decompress_file(source + ".bz2", destination)
+                metrics.count("local_frames", 1)
+
+            else:
+                raise Exception(
+                    "{0}-{1}-{2}-{3}: {4} is not in {5}.".format(
+                        rerun, run, camcol, field,
+                        os.path.basename(source), self.root
+                    )
+                )
+
+            paths.append(destination)
+
+        return paths
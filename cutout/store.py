@@ -0,0 +1,786 @@
+import json
+import os
+import random
+import shutil
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from cutout import metrics
+from cutout.sdss import read_match_csv
+
+
+class ChunkedWriter(object):
+    """
+    Appends records with a fixed dtype to preallocated, memory-mapped
+    .npy chunks in a directory.
+
+    After every append, the chunk is flushed and the number of valid
+    records is committed as a line in 'index.log', so a crash never
+    loses the records written before it, and an append costs the same
+    however many came before. The log is folded into 'index.json' when
+    the writer is opened and closed (see read_index). Opening a writer
+    on an existing directory continues where the previous one stopped.
+
+    Parameters
+    ----------
+    path: A directory.
+    dtype: A numpy dtype.
+    shape: The shape of a single record, e.g. (5, 64, 64) for plain
+        float arrays of cutouts, or () for structured records.
+    chunk_size: Number of records per chunk.
+    """
+
+    def __init__(self, path, dtype, shape=(), chunk_size=256):
+
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.completed = set()
+        self._chunk = None
+        self._log = None
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        if os.path.exists(os.path.join(path, "index.json")):
+            index = read_index(path)
+            self.chunk_size = index["chunk_size"]
+            self.chunks = index["chunks"]
+            self.completed = set(index["completed"])
+
+        # also drops a log line that a crash cut short.
+        self._write_index()
+
+    def __len__(self):
+        return sum(chunk["count"] for chunk in self.chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, records, key=None):
+        """
+        Appends records, and marks key (e.g. a field) as completed.
+        """
+
+        records = np.asarray(records, dtype=self.dtype)
+
+        with metrics.timer("save"):
+            self._append(records)
+
+        metrics.count("bytes_written", records.nbytes)
+
+        if key is not None:
+            self.completed.add(key)
+
+        self._commit(key)
+
+        return None
+
+    def _append(self, records):
+
+        start = 0
+
+        while start < len(records):
+
+            if not self.chunks or self.chunks[-1]["count"] == self.chunk_size:
+                self._new_chunk()
+            elif self._chunk is None:
+                self._chunk = np.load(
+                    os.path.join(self.path, self.chunks[-1]["file"]),
+                    mmap_mode="r+"
+                )
+
+            count = self.chunks[-1]["count"]
+            n = min(self.chunk_size - count, len(records) - start)
+
+            self._chunk[count: count + n] = records[start: start + n]
+            self._chunk.flush()
+
+            self.chunks[-1]["count"] += n
+            start += n
+
+    def close(self):
+        """
+        Flushes and closes the current chunk, and folds the log into
+        'index.json'.
+        """
+
+        self._close_chunk()
+
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+            self._write_index()
+
+        return None
+
+    def read(self):
+        """
+        Returns all committed records as a single array.
+        """
+
+        empty = np.zeros((0,) + self.shape, dtype=self.dtype)
+
+        return np.concatenate([empty] + list(self.iter_chunks()))
+
+    def iter_chunks(self):
+        """
+        Yields the committed records of each chunk as a memory-mapped array.
+        """
+
+        for chunk in self.chunks:
+            array = np.load(
+                os.path.join(self.path, chunk["file"]), mmap_mode="r"
+            )
+            yield array[:chunk["count"]]
+
+    def finalize(self, filename):
+        """
+        Copies all records into a single .npy file, one chunk at a time,
+        and removes the chunk directory.
+        """
+
+        self.close()
+
+        temp_file = filename + ".tmp.npy"
+
+        if len(self) > 0:
+            result = np.lib.format.open_memmap(
+                temp_file, mode="w+", dtype=self.dtype,
+                shape=(len(self),) + self.shape
+            )
+            start = 0
+            for chunk in self.iter_chunks():
+                result[start: start + len(chunk)] = chunk
+                start += len(chunk)
+            result.flush()
+            del result
+        else:
+            np.save(temp_file, np.zeros((0,) + self.shape, dtype=self.dtype))
+
+        os.replace(temp_file, filename)
+        shutil.rmtree(self.path)
+
+        return filename
+
+    def _close_chunk(self):
+
+        if self._chunk is not None:
+            self._chunk.flush()
+            self._chunk = None
+
+    def _new_chunk(self):
+
+        self._close_chunk()
+
+        name = "chunk-{:05d}.npy".format(len(self.chunks))
+
+        self._chunk = np.lib.format.open_memmap(
+            os.path.join(self.path, name), mode="w+",
+            dtype=self.dtype, shape=(self.chunk_size,) + self.shape
+        )
+        self.chunks.append({"file": name, "count": 0})
+
+    def _commit(self, key):
+
+        if self._log is None:
+            self._log = open(os.path.join(self.path, "index.log"), "a")
+
+        self._log.write(json.dumps({"length": len(self), "key": key}) + "\n")
+        self._log.flush()
+
+    def _write_index(self):
+
+        index = {
+            "chunk_size": self.chunk_size,
+            "chunks": self.chunks,
+            "completed": sorted(self.completed)
+        }
+
+        index_file = os.path.join(self.path, "index.json")
+
+        with open(index_file + ".tmp", "w") as f:
+            json.dump(index, f)
+
+        os.replace(index_file + ".tmp", index_file)
+
+        log_file = os.path.join(self.path, "index.log")
+
+        if os.path.exists(log_file):
+            os.remove(log_file)
+
+
+def read_index(path):
+    """
+    Reads the index of a ChunkedWriter directory, including the appends
+    in 'index.log' that are not in 'index.json' yet.
+
+    Returns
+    -------
+    A dictionary with the chunk_size, the chunks (a list of dictionaries
+    with the file name and the number of records) and the completed keys.
+    """
+
+    with open(os.path.join(path, "index.json")) as f:
+        index = json.load(f)
+
+    log_file = os.path.join(path, "index.log")
+
+    if not os.path.exists(log_file):
+        return index
+
+    chunk_size = index["chunk_size"]
+    length = sum(chunk["count"] for chunk in index["chunks"])
+
+    with open(log_file) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line of a writer that crashed.
+                break
+            length = entry["length"]
+            if entry["key"] is not None:
+                index["completed"].append(entry["key"])
+
+    # the chunks are filled one after another.
+    index["chunks"] = [
+        {
+            "file": "chunk-{:05d}.npy".format(i),
+            "count": min(chunk_size, length - i * chunk_size)
+        }
+        for i in range((length + chunk_size - 1) // chunk_size)
+    ]
+
+    return index
+
+
+def consolidate(result_dir, output_dir, shard_size=65536, remove=False):
+    """
+    Packs the per-field .npy files of match mode into large shards of
+    shard_size records, and builds an objID index for ShardedDataset.
+
+    Consolidation can be resumed: files that were already packed into
+    output_dir are skipped.
+
+    Parameters
+    ----------
+    result_dir: The directory with per-field .npy files.
+    output_dir: The directory of the sharded dataset.
+    shard_size: Number of records per shard.
+    remove: If True, the per-field files are removed once they are packed.
+
+    Returns
+    -------
+    A ShardedDataset.
+    """
+
+    files = sorted(
+        f for f in os.listdir(result_dir)
+        if f.endswith(".npy") and os.path.isfile(os.path.join(result_dir, f))
+    )
+
+    writer = None
+
+    for filename in files:
+
+        file_path = os.path.join(result_dir, filename)
+        records = np.load(file_path, mmap_mode="r")
+
+        if records.dtype.names is None or "objID" not in records.dtype.names:
+            raise ValueError(
+                "{}: Not a match mode result (no objID).".format(filename)
+            )
+
+        if writer is None:
+            writer = ChunkedWriter(
+                output_dir, records.dtype, chunk_size=shard_size
+            )
+        elif records.dtype != writer.dtype:
+            raise ValueError(
+                "{}: Inconsistent dtype {}.".format(filename, records.dtype)
+            )
+
+        if filename not in writer.completed:
+            writer.append(records, key=filename)
+
+        del records
+
+        if remove:
+            os.remove(file_path)
+
+    if writer is None:
+        raise ValueError("{}: No .npy files found.".format(result_dir))
+
+    writer.close()
+    build_index(writer)
+
+    return ShardedDataset(output_dir)
+
+
+def build_index(writer):
+    """
+    Writes 'index.npy' with the objID, shard and offset of every record
+    written by a ChunkedWriter, sorted by objID.
+    """
+
+    dtype = [("objID", "u8"), ("shard", "u4"), ("offset", "u8")]
+    index = np.zeros(len(writer), dtype=dtype)
+
+    start = 0
+
+    for ishard, shard in enumerate(writer.iter_chunks()):
+        stop = start + len(shard)
+        index["objID"][start: stop] = shard["objID"]
+        index["shard"][start: stop] = ishard
+        index["offset"][start: stop] = np.arange(len(shard))
+        start = stop
+
+    index = index[np.argsort(index["objID"], kind="mergesort")]
+
+    np.save(os.path.join(writer.path, "index.npy"), index)
+
+    return None
+
+
+def present_objids(path):
+    """
+    Returns the sorted objIDs already in a match mode output: a sharded
+    dataset (with 'index.npy'), or a directory of per-field .npy files.
+    """
+
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=np.uint64)
+
+    index_file = os.path.join(path, "index.npy")
+
+    if os.path.exists(index_file):
+
+        indexed = np.load(index_file, mmap_mode="r")["objID"].copy()
+
+        # records appended after the index was built, e.g. by a run
+        # that crashed before calling build_index.
+        new = []
+        start = 0
+
+        for chunk in read_index(path)["chunks"]:
+            stop = start + chunk["count"]
+            if stop > len(indexed):
+                shard = np.load(
+                    os.path.join(path, chunk["file"]), mmap_mode="r"
+                )
+                first = max(len(indexed) - start, 0)
+                new.append(np.array(
+                    shard["objID"][first: chunk["count"]], dtype=np.uint64
+                ))
+                del shard
+            start = stop
+
+        if not new:
+            return indexed
+
+        return np.unique(np.concatenate([indexed] + new))
+
+    objids = []
+
+    for filename in sorted(os.listdir(path)):
+        file_path = os.path.join(path, filename)
+        if not filename.endswith(".npy") or not os.path.isfile(file_path):
+            continue
+        records = np.load(file_path, mmap_mode="r")
+        if records.dtype.names is None or "objID" not in records.dtype.names:
+            continue
+        objids.append(np.array(records["objID"], dtype=np.uint64))
+        del records
+
+    if not objids:
+        return np.zeros(0, dtype=np.uint64)
+
+    return np.unique(np.concatenate(objids))
+
+
+def save_records(records, filename):
+    """
+    Saves an array of records in filename, which is replaced
+    atomically.
+    """
+
+    temp_file = filename + ".tmp.npy"
+
+    with metrics.timer("save"):
+        np.save(temp_file, records)
+        os.replace(temp_file, filename)
+
+    metrics.count("bytes_written", records.nbytes)
+
+    return filename
+
+
+def merge_records(new_file, result_file):
+    """
+    Appends the records in new_file to result_file (or moves new_file
+    to result_file if there is none yet), and removes new_file.
+    result_file is replaced atomically.
+    """
+
+    if not os.path.exists(result_file):
+        os.replace(new_file, result_file)
+        return result_file
+
+    old = np.load(result_file, mmap_mode="r")
+    new = np.load(new_file, mmap_mode="r")
+
+    if old.dtype != new.dtype or old.shape[1:] != new.shape[1:]:
+        raise ValueError(
+            "{}: Inconsistent dtype {}.".format(new_file, new.dtype)
+        )
+
+    temp_file = result_file + ".tmp.npy"
+
+    merged = np.lib.format.open_memmap(
+        temp_file, mode="w+", dtype=old.dtype,
+        shape=(len(old) + len(new),) + old.shape[1:]
+    )
+    merged[:len(old)] = old
+    merged[len(old):] = new
+    merged.flush()
+
+    del merged, old, new
+
+    os.replace(temp_file, result_file)
+    os.remove(new_file)
+
+    return result_file
+
+
+def append_to_dataset(new_file, output_dir, key):
+    """
+    Appends the records in new_file to the sharded dataset in output_dir
+    under key, and removes new_file. The objID index is not updated;
+    call build_index on the returned writer after the last append.
+    """
+
+    records = np.load(new_file, mmap_mode="r")
+
+    writer = ChunkedWriter(output_dir, records.dtype)
+
+    if writer.chunks:
+        shard = np.load(
+            os.path.join(output_dir, writer.chunks[0]["file"]), mmap_mode="r"
+        )
+        if shard.dtype != records.dtype:
+            raise ValueError(
+                "{}: Inconsistent dtype {}.".format(new_file, records.dtype)
+            )
+        del shard
+
+    if key not in writer.completed:
+        writer.append(records, key=key)
+
+    writer.close()
+    del records
+
+    os.remove(new_file)
+
+    return writer
+
+
+class ShardedDataset(object):
+    """
+    Reads a dataset written by consolidate.
+
+    The shards are memory-mapped, so only the records that are accessed
+    are read from disk. Records can be accessed by position
+    (dataset[i], dataset[[i, j, k]], dataset[start:stop]), by objID
+    (dataset.get(objIDs)), or in minibatches (dataset.batches(...)).
+    """
+
+    def __init__(self, path):
+
+        index = read_index(path)
+
+        self.path = path
+        self.shards = [
+            np.load(os.path.join(path, chunk["file"]), mmap_mode="r")[
+                :chunk["count"]
+            ]
+            for chunk in index["chunks"]
+        ]
+        self.starts = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.index = np.load(os.path.join(path, "index.npy"), mmap_mode="r")
+        self.dtype = self.shards[0].dtype
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, key):
+
+        if isinstance(key, slice):
+            key = np.arange(len(self))[key]
+
+        if np.isscalar(key):
+            key = int(self._position(np.int64(key)))
+            ishard = np.searchsorted(self.starts, key, side="right") - 1
+            return self.shards[ishard][key - self.starts[ishard]]
+
+        key = self._position(np.asarray(key, dtype=np.int64))
+        shard = np.searchsorted(self.starts, key, side="right") - 1
+
+        return self._gather(shard, key - self.starts[shard])
+
+    def __iter__(self):
+
+        for shard in self.shards:
+            for record in shard:
+                yield record
+
+    def _position(self, key):
+        """
+        Converts (negative) positions to offsets from the start, and
+        raises IndexError for positions outside the dataset.
+        """
+
+        n = len(self)
+
+        if np.any(key >= n) or np.any(key < -n):
+            raise IndexError(
+                "Index out of range for a dataset of {} records.".format(n)
+            )
+
+        return np.where(key < 0, key + n, key)
+
+    def get(self, objIDs):
+        """
+        Returns the records with the given objIDs.
+        Raises KeyError if an objID is not in the dataset.
+        """
+
+        objIDs = np.atleast_1d(np.asarray(objIDs, dtype=np.uint64))
+
+        ids = self.index["objID"]
+        pos = np.searchsorted(ids, objIDs)
+        pos = np.minimum(pos, len(ids) - 1)
+
+        missing = ids[pos] != objIDs
+        if missing.any():
+            raise KeyError(objIDs[missing].tolist())
+
+        entries = self.index[pos]
+
+        return self._gather(
+            entries["shard"].astype(np.intp), entries["offset"].astype(np.intp)
+        )
+
+    def batches(self, batch_size=256, shuffle=False, seed=None):
+        """
+        Yields the dataset in minibatches of batch_size records,
+        in a random order if shuffle is True.
+        """
+
+        order = np.arange(len(self))
+
+        if shuffle:
+            np.random.RandomState(seed).shuffle(order)
+
+        for start in range(0, len(order), batch_size):
+            yield self[order[start: start + batch_size]]
+
+    def _gather(self, shard, offset):
+
+        result = np.empty(len(shard), dtype=self.dtype)
+
+        for ishard in np.unique(shard):
+            rows = np.nonzero(shard == ishard)[0]
+            # reading in file order is much faster on memory-mapped files.
+            order = np.argsort(offset[rows], kind="mergesort")
+            result[rows[order]] = self.shards[ishard][offset[rows][order]]
+
+        return result
+
+
+def partition_catalog(filename, shuffle=True, save_dir="temp",
+    skip_exists=True, return_counts=False, chunksize=1000000):
+    """
+    Partitions a match CSV file by field without loading it in memory.
+
+    The CSV file is read twice in chunks of chunksize rows: once to count
+    the objects in each field, and once to scatter the rows into a binary
+    table sorted by field, '<save_dir>/catalog.npy'. The rows of each
+    field are located with '<save_dir>/offsets.npy', and are read back
+    with read_partition.
+
+    The path, size and modification time of the CSV file are recorded
+    in '<save_dir>/source.json'. With skip_exists=True, an existing
+    partition is reused only if it was made from the same file.
+
+    Returns
+    -------
+    A list of group names such as 'frame-301-109-2-37', and with
+    return_counts=True also a dictionary with the number of objects
+    in each group.
+    """
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    catalog_file = os.path.join(save_dir, "catalog.npy")
+    offsets_file = os.path.join(save_dir, "offsets.npy")
+    source_file = os.path.join(save_dir, "source.json")
+
+    keys = ["rerun", "run", "camcol", "field"]
+
+    stat = os.stat(filename)
+    source = {
+        "path": os.path.abspath(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime
+    }
+
+    if not (skip_exists and os.path.exists(offsets_file)
+        and _read_json(source_file) == source):
+
+        if os.path.exists(source_file):
+            os.remove(source_file)
+
+        columns = pd.read_csv(filename, nrows=0).columns
+        dtype = partition_dtype(columns)
+
+        counts = {}
+
+        for chunk in read_match_csv(
+            filename, shuffle=False, chunksize=chunksize):
+            for key, n in chunk.groupby(keys).size().items():
+                key = tuple(int(i) for i in key)
+                counts[key] = counts.get(key, 0) + n
+
+        fields = sorted(counts)
+
+        offsets = np.zeros(
+            len(fields),
+            dtype=[(k, "u2") for k in keys] + [("start", "u8"), ("stop", "u8")]
+        )
+        for k, values in zip(keys, zip(*fields)):
+            offsets[k] = values
+        offsets["stop"] = np.cumsum([counts[f] for f in fields])
+        offsets["start"] = offsets["stop"] - [counts[f] for f in fields]
+
+        cursor = {f: int(start) for f, start in zip(fields, offsets["start"])}
+
+        table = np.lib.format.open_memmap(
+            catalog_file + ".tmp.npy", mode="w+", dtype=dtype,
+            shape=(int(offsets["stop"][-1]) if len(fields) else 0,)
+        )
+
+        for chunk in read_match_csv(
+            filename, shuffle=False, chunksize=chunksize):
+
+            records = np.zeros(len(chunk), dtype=dtype)
+            for name in records.dtype.names:
+                records[name] = chunk[name].values
+
+            destination = np.zeros(len(chunk), dtype=np.int64)
+
+            for key, rows in chunk.groupby(keys).indices.items():
+                key = tuple(int(i) for i in key)
+                destination[rows] = cursor[key] + np.arange(len(rows))
+                cursor[key] += len(rows)
+
+            table[destination] = records
+
+        table.flush()
+        del table
+
+        os.replace(catalog_file + ".tmp.npy", catalog_file)
+        np.save(offsets_file, offsets)
+
+        with open(source_file, "w") as f:
+            json.dump(source, f)
+
+    offsets = np.load(offsets_file)
+
+    group_list = [
+        "frame-{}-{}-{}-{}".format(*(int(o[k]) for k in keys))
+        for o in offsets
+    ]
+    counts = dict(
+        zip(group_list, (offsets["stop"] - offsets["start"]).tolist())
+    )
+
+    if shuffle:
+        random.shuffle(group_list)
+
+    if return_counts:
+        return group_list, counts
+
+    return group_list
+
+
+def _read_json(path):
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def partition_dtype(columns):
+    """
+    Returns the dtype of the partitioned catalog for the given CSV columns.
+    """
+
+    dtype = [
+        ("objID", "u8"),
+        ("ra", "f8"),
+        ("dec", "f8"),
+        ("rerun", "u2"),
+        ("run", "u2"),
+        ("camcol", "u2"),
+        ("field", "u2")
+    ]
+
+    if "class" in columns:
+        dtype += [("class", "U8")]
+
+    if "z" in columns:
+        dtype += [("z", "f8")]
+
+    return dtype
+
+
+def read_partition(group, save_dir="temp"):
+    """
+    Returns the objects of a single field of a partitioned catalog as
+    a pandas dataframe. Only the rows of the field are read from the
+    memory-mapped table.
+    """
+
+    save_dir = os.path.abspath(save_dir)
+    mtime = os.path.getmtime(os.path.join(save_dir, "offsets.npy"))
+
+    catalog, index = _open_partition(save_dir, mtime)
+
+    start, stop = index[group]
+
+    return pd.DataFrame(np.array(catalog[start: stop]))
+
+
+@lru_cache(maxsize=4)
+def _open_partition(save_dir, mtime):
+
+    catalog = np.load(os.path.join(save_dir, "catalog.npy"), mmap_mode="r")
+    offsets = np.load(os.path.join(save_dir, "offsets.npy"))
+
+    index = {
+        "frame-{}-{}-{}-{}".format(
+            o["rerun"], o["run"], o["camcol"], o["field"]
+        ): (int(o["start"]), int(o["stop"]))
+        for o in offsets
+    }
+
+    return catalog, index
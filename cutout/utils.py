@@ -1,24 +1,51 @@
 import os
+import shutil
+import warnings
 import numpy as np
 import pandas as pd
-import montage_wrapper as mw
+from astropy.io import fits
+from astropy import wcs
+from cutout import metrics
 
 
-def align_images(images, reference, save_dir=None):
+def align_images(images, reference, save_dir=None, method="montage",
+    tolerance=0.01):
     """
     Aligns images to the reference image.
     The file names must end with ".fits".
 
+    With method="montage", the registered images are written to
+    save_dir as "*.registered.fits". With method="numpy", the images
+    are reprojected in memory and returned as arrays; the reference
+    image is returned as its file name.
+
+    The bands of an SDSS field usually differ from each other by a
+    translation, so each image is first compared with the reference
+    (see translation_offset). An image whose pixels are within tolerance
+    pixels of the reference grid is used as it is, an image that is only
+    translated is shifted (see shift_array), and only the other images
+    are fully reprojected. Pass tolerance=None to always reproject.
+
     Parameters
     ----------
     images: A list of strings.
     reference: A string.
+    method: "montage" or "numpy".
+    tolerance: A float (pixels), or None.
 
     Returns
     -------
-    None
+    None for method="montage", a list of numpy arrays and strings
+    for method="numpy".
     """
 
+    if method == "numpy":
+        with metrics.timer("reproject", method=method):
+            return reproject_images(images, reference, tolerance)
+
+    if method != "montage":
+        raise ValueError("Unknown alignment method: {}".format(method))
+
     if save_dir is None:
         save_dir = os.getcwd()
 
@@ -27,13 +54,41 @@ def align_images(images, reference, save_dir=None):
         for image in images
     ]
 
+    reference_header = fits.getheader(reference)
+    reference_wcs = wcs.WCS(reference_header, relax=False)
+    shape = (reference_header["NAXIS2"], reference_header["NAXIS1"])
+
+    montage_images = []
+    montage_path = []
+
+    for image, path in zip(images, registered_path):
+
+        with metrics.timer("reproject", method="shift"):
+            aligned = fast_align(
+                image, reference_wcs, shape, tolerance
+            )
+
+        if aligned is None:
+            montage_images.append(image)
+            montage_path.append(path)
+        elif isinstance(aligned, str):
+            _link_or_copy(image, path)
+        else:
+            fits.writeto(path, aligned, reference_header, overwrite=True)
+
+    if not montage_images:
+        return None
+
+    import montage_wrapper as mw
+
     header = reference.replace(".fits", ".header")
-    mw.commands.mGetHdr(reference, header)
 
-    mw.reproject(
-        images, registered_path,
-        header=header, exact_size=True, silent_cleanup=True, common=True
-    )
+    with metrics.timer("reproject", method=method):
+        mw.commands.mGetHdr(reference, header)
+        mw.reproject(
+            montage_images, montage_path,
+            header=header, exact_size=True, silent_cleanup=True, common=True
+        )
 
     if os.path.exists(header):
         os.remove(header)
@@ -41,11 +96,309 @@ def align_images(images, reference, save_dir=None):
     return None
 
 
-def nanomaggie_to_luptitude(array, band):
+def _link_or_copy(source, destination):
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def reproject_images(images, reference, tolerance=0.01):
+    """
+    Reprojects images onto the pixel grid of the reference image in memory.
+    Images that are already aligned, or only translated, take the fast
+    paths of align_images.
+
+    Parameters
+    ----------
+    images: A list of strings.
+    reference: A string.
+    tolerance: A float (pixels), or None.
+
+    Returns
+    -------
+    A list with a numpy array for each image, and the file name in place
+    of the reference image and of images that are already aligned.
+    """
+
+    reference_header = fits.getheader(reference)
+    reference_wcs = wcs.WCS(reference_header, relax=False)
+    shape = (reference_header["NAXIS2"], reference_header["NAXIS1"])
+
+    result = []
+
+    for image in images:
+
+        if image == reference:
+            result.append(reference)
+            continue
+
+        aligned = fast_align(image, reference_wcs, shape, tolerance)
+
+        if aligned is None:
+            data, header = fits.getdata(image, header=True, memmap=True)
+            image_wcs = wcs.WCS(header, relax=False)
+            aligned = reproject_array(data, image_wcs, reference_wcs, shape)
+
+        result.append(aligned)
+
+    return result
+
+
+def fast_align(image, reference_wcs, shape, tolerance=0.01):
+    """
+    Aligns an image to the grid of the reference WCS (and shape) if
+    that does not need a full reprojection.
+
+    Returns
+    -------
+    The file name if the image is already aligned within tolerance
+    pixels, a shifted numpy array if the image is only translated,
+    and None otherwise (or if tolerance is None).
+    """
+
+    if tolerance is None:
+        metrics.count("align_reprojected", 1)
+        return None
+
+    header = fits.getheader(image)
+    image_wcs = wcs.WCS(header, relax=False)
+
+    offset = translation_offset(image_wcs, reference_wcs, shape, tolerance)
+
+    if offset is None:
+        metrics.count("align_reprojected", 1)
+        return None
+
+    dx, dy = offset
+    image_shape = (header["NAXIS2"], header["NAXIS1"])
+
+    if abs(dx) <= tolerance and abs(dy) <= tolerance and image_shape == shape:
+        metrics.count("align_skipped", 1)
+        return image
+
+    metrics.count("align_shifted", 1)
+
+    data = fits.getdata(image, memmap=True)
+
+    return shift_array(data, dx, dy, shape, tolerance)
+
+
+def translation_offset(wcs_in, wcs_out, shape_out, tolerance=0.01, n=5):
+    """
+    Checks whether the pixel grid of wcs_in differs from the grid of
+    shape_out pixels described by wcs_out by a translation only.
+
+    n x n points spread over the output grid are mapped onto the input
+    grid. If the offsets of all points agree within tolerance pixels,
+    the pixel scale and orientation are the same, and the mapping is
+    a translation.
+
+    Returns
+    -------
+    A tuple of (dx, dy), the input minus the output pixel position,
+    or None if the mapping is not a translation.
+    """
+
+    ny, nx = shape_out
+
+    y_out, x_out = np.meshgrid(
+        np.linspace(0, ny - 1, n), np.linspace(0, nx - 1, n), indexing="ij"
+    )
+
+    ra, dec = wcs_out.all_pix2world(x_out, y_out, 0)
+    x_in, y_in = wcs_in.all_world2pix(ra, dec, 0)
+
+    dx = x_in - x_out
+    dy = y_in - y_out
+
+    if not (np.all(np.isfinite(dx)) and np.all(np.isfinite(dy))):
+        return None
+
+    if np.ptp(dx) > tolerance or np.ptp(dy) > tolerance:
+        return None
+
+    return float(np.mean(dx)), float(np.mean(dy))
+
+
+def shift_array(data, dx, dy, shape_out, tolerance=0.01):
+    """
+    Samples data at (x + dx, y + dy) for every pixel (x, y) of a grid of
+    shape_out pixels, with bilinear interpolation as in reproject_array,
+    but with four shifted slices of the whole array instead of
+    per-pixel coordinates. Offsets within tolerance of a whole pixel
+    are rounded, so the pixels are copied without interpolation.
+    Pixels that fall outside data are set to NaN.
+
+    Returns
+    -------
+    A float32 numpy array.
+    """
+
+    data = np.asarray(data)
+    ny, nx = shape_out
+
+    ix = int(np.floor(dx))
+    iy = int(np.floor(dy))
+    fx = dx - ix
+    fy = dy - iy
+
+    if fx <= tolerance:
+        fx = 0.0
+    elif fx >= 1 - tolerance:
+        ix, fx = ix + 1, 0.0
+
+    if fy <= tolerance:
+        fy = 0.0
+    elif fy >= 1 - tolerance:
+        iy, fy = iy + 1, 0.0
+
+    kx = 1 if fx > 0 else 0
+    ky = 1 if fy > 0 else 0
+
+    output = np.full(shape_out, np.nan, dtype=np.float32)
+
+    # output pixels whose input pixels all lie inside data.
+    x0 = max(0, -ix)
+    y0 = max(0, -iy)
+    x1 = min(nx, data.shape[1] - ix - kx)
+    y1 = min(ny, data.shape[0] - iy - ky)
+
+    if x1 <= x0 or y1 <= y0:
+        return output
+
+    terms = [
+        (0, 0, (1 - fx) * (1 - fy)),
+        (1, 0, fx * (1 - fy)),
+        (0, 1, (1 - fx) * fy),
+        (1, 1, fx * fy)
+    ]
+
+    window = output[y0:y1, x0:x1]
+    window[...] = 0
+
+    for ox, oy, weight in terms:
+        if weight == 0:
+            continue
+        window += np.float32(weight) * data[
+            y0 + iy + oy: y1 + iy + oy, x0 + ix + ox: x1 + ix + ox
+        ]
+
+    return output
+
+
+def reproject_array(data, wcs_in, wcs_out, shape_out, block=256):
+    """
+    Reprojects a 2-d array from wcs_in onto a grid of shape_out pixels
+    described by wcs_out, using bilinear interpolation. Pixels that
+    fall outside the input image are set to NaN.
+
+    The output is computed in blocks of rows to bound the memory used
+    by the coordinate arrays.
+
+    Returns
+    -------
+    A numpy array.
+    """
+
+    ny, nx = shape_out
+    output = np.empty(shape_out, dtype=np.float32)
+
+    for y0 in range(0, ny, block):
+        y1 = min(y0 + block, ny)
+        y_out, x_out = np.mgrid[y0:y1, 0:nx]
+        output[y0:y1] = resample(data, wcs_in, wcs_out, x_out, y_out)
+
+    return output
+
+
+def reproject_stamps(data, wcs_in, wcs_out, up, right, size=64):
+    """
+    Reprojects only the size x size windows with upper-left corners
+    (up, right) on the grid described by wcs_out, instead of the
+    whole image. Each window reads only the pixels of data that lie
+    under it, plus a one pixel border for the interpolation.
+
+    Returns
+    -------
+    A numpy array of shape (len(up), size, size).
+    """
+
+    offset = np.arange(size)
+
+    x_out = np.asarray(right)[:, None, None] + offset[None, None, :]
+    y_out = np.asarray(up)[:, None, None] + offset[None, :, None]
+
+    x_out, y_out = np.broadcast_arrays(x_out, y_out)
+
+    return resample(data, wcs_in, wcs_out, x_out, y_out)
+
+
+def resample(data, wcs_in, wcs_out, x_out, y_out):
+    """
+    Samples data (with WCS wcs_in) at the zero-based pixel positions
+    (x_out, y_out) of the grid described by wcs_out.
+
+    Returns
+    -------
+    A numpy array with the shape of x_out.
+    """
+
+    ra, dec = wcs_out.all_pix2world(x_out, y_out, 0)
+    x_in, y_in = wcs_in.all_world2pix(ra, dec, 0)
+
+    return interpolate_bilinear(data, x_in, y_in)
+
+
+def interpolate_bilinear(data, x, y):
+    """
+    Bilinear interpolation of a 2-d array at zero-based pixel positions.
+    Positions outside the array are set to NaN.
+    """
+
+    data = np.asarray(data)
+    ny, nx = data.shape
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    outside = ~(np.isfinite(x) & np.isfinite(y))
+    outside |= (x < 0) | (x > nx - 1) | (y < 0) | (y > ny - 1)
+
+    x = np.clip(np.where(outside, 0, x), 0, nx - 1)
+    y = np.clip(np.where(outside, 0, y), 0, ny - 1)
+
+    x0 = np.minimum(np.floor(x).astype(np.intp), nx - 2)
+    y0 = np.minimum(np.floor(y).astype(np.intp), ny - 2)
+
+    dx = x - x0
+    dy = y - y0
+
+    result = (
+        data[y0, x0] * (1 - dx) * (1 - dy) +
+        data[y0, x0 + 1] * dx * (1 - dy) +
+        data[y0 + 1, x0] * (1 - dx) * dy +
+        data[y0 + 1, x0 + 1] * dx * dy
+    )
+
+    result[outside] = np.nan
+
+    return result
+
+
+def nanomaggie_to_luptitude(array, band, out=None):
     '''
     Converts nanomaggies (flux) to luptitudes (magnitude).
     http://www.sdss.org/dr12/algorithms/magnitudes/#asinh
     http://arxiv.org/abs/astro-ph/9903081
+
+    The computation is done in float32 with in-place operations. If out
+    is given (a float32 array, or a view of one), the result is written
+    into it; otherwise a new float32 array is returned.
     '''
     b = {
         'u': 1.4e-10,
@@ -54,10 +407,91 @@ def nanomaggie_to_luptitude(array, band):
         'i': 1.8e-10,
         'z': 7.4e-10
     }
-    nanomaggie = array * 1.0e-9 # fluxes are in nanomaggies
-
-    luptitude = -2.5 / np.log(10) * (
-        np.arcsinh((nanomaggie / (2 * b[band]))) + np.log(b[band])
+    # fluxes are in nanomaggies
+    luptitude = np.multiply(
+        array, np.float32(1.0e-9), out=out, dtype=np.float32
     )
-    
+
+    luptitude /= np.float32(2 * b[band])
+    np.arcsinh(luptitude, out=luptitude)
+    luptitude += np.float32(np.log(b[band]))
+    luptitude *= np.float32(-2.5 / np.log(10))
+
     return luptitude
+
+
+IMAGE_DTYPES = ("float32", "float16", "uint16")
+
+# the largest uint16 value marks missing (NaN) pixels.
+_UINT16_MISSING = 65535
+
+
+def encode_images(array, dtype="float32"):
+    """
+    Converts cutouts to the output dtype.
+
+    With dtype="uint16", each band of each cutout is scaled linearly
+    to 0-65534 between its minimum and maximum, and NaN pixels are
+    stored as 65535. The offset and scale are needed to decode it.
+
+    Parameters
+    ----------
+    array: A float32 numpy array of shape (n, bands, size, size).
+    dtype: "float32", "float16" or "uint16".
+
+    Returns
+    -------
+    A tuple of (images, offset, scale). offset and scale are float32
+    arrays of shape (n, bands) for uint16, and None otherwise.
+    """
+
+    if dtype not in IMAGE_DTYPES:
+        raise ValueError("Unknown image dtype '{}'.".format(dtype))
+
+    if dtype != "uint16":
+        return array.astype(dtype, copy=False), None, None
+
+    n, nb = array.shape[:2]
+    flat = array.reshape(n, nb, -1)
+    missing = np.isnan(flat)
+
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        offset = np.nanmin(flat, axis=-1)
+        scale = np.nanmax(flat, axis=-1)
+
+    # cutouts with no valid pixels.
+    offset[np.isnan(offset)] = 0
+    scale[np.isnan(scale)] = 0
+
+    scale -= offset
+    scale /= np.float32(_UINT16_MISSING - 1)
+    scale[scale == 0] = 1
+
+    scaled = flat - offset[..., None]
+    scaled /= scale[..., None]
+    np.rint(scaled, out=scaled)
+    scaled[missing] = _UINT16_MISSING
+
+    images = scaled.astype(np.uint16).reshape(array.shape)
+
+    return images, offset.astype(np.float32), scale.astype(np.float32)
+
+
+def decode_images(records):
+    """
+    Returns the cutouts in a structured array written by the match mode
+    as a float32 array, whatever the stored dtype.
+    """
+
+    images = records["image"]
+
+    if images.dtype != np.uint16:
+        return images.astype(np.float32)
+
+    result = images.astype(np.float32)
+    result *= records["scale"][..., None, None]
+    result += records["offset"][..., None, None]
+    result[images == _UINT16_MISSING] = np.nan
+
+    return result
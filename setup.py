@@ -14,5 +14,8 @@ setup(
         'requests',
         'astropy',
         'montage-wrapper'
-    ]
+    ],
+    extras_require={
+        'detect': ['scipy']
+    }
 )